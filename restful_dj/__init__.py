@@ -1,8 +1,12 @@
+from .cache import CacheBackend, register_cache_backend, invalidate_cache, cache_info
 from .decorator import route
 from .meta import RouteMeta
 from .middleware import register_middlewares
-from .router import set_before_dispatch_handler, register_routes, map_routes
+from .pool import register_pool, pool_info
+from .router import set_before_dispatch_handler, register_routes, map_routes, warmup_routes, preload
 from .util.collector import collect, persist, register_globals
+from .util.codec import set_json_codec
+from .util.converter import register_converter
 from .util.logger import set_logger
 
 
@@ -12,12 +16,33 @@ def _initialize():
 
     from . import router
 
-    _routes = [
-        path('<str:entry>', router.dispatch),
-        path('<str:entry>/', router.redirect),
-        path('<str:entry>/<str:name>', router.dispatch),
-        path('<str:entry>/<str:name>/', router.redirect)
-    ]
+    use_async = getattr(settings, 'RESTFUL_DJ_ASYNC', False)
+
+    # 使用异步的分发入口(ASGI)
+    if use_async:
+        dispatch_view, dispatch_path_view = router.dispatch_async, router.dispatch_path_async
+    else:
+        dispatch_view, dispatch_path_view = router.dispatch, router.dispatch_path
+
+    if getattr(settings, 'RESTFUL_DJ_CATCH_ALL', False):
+        # 使用单一入口，由 restful-dj 自行拆分路径，以 / 结尾的地址不会被重定向
+        _routes = [
+            path('<path:route_path>', dispatch_path_view)
+        ]
+    else:
+        _routes = [
+            path('<str:entry>', dispatch_view),
+            path('<str:entry>/', router.redirect),
+            path('<str:entry>/<str:name>', dispatch_view),
+            path('<str:entry>/<str:name>/', router.redirect)
+        ]
+
+    # 批量请求入口，需要在其它地址之前匹配
+    batch_path = getattr(settings, 'RESTFUL_DJ_BATCH', None)
+    if batch_path:
+        from . import batch
+
+        _routes.insert(0, path(batch_path, batch.batch_async if use_async else batch.batch))
 
     if settings.DEBUG:
         from . import apis
@@ -41,9 +66,19 @@ __all__ = [
     'RouteMeta',
     'set_before_dispatch_handler',
     'set_logger',
+    'set_json_codec',
     'map_routes',
     'register_globals',
+    'register_converter',
     'register_routes',
     'register_middlewares',
+    'register_pool',
+    'pool_info',
+    'CacheBackend',
+    'register_cache_backend',
+    'invalidate_cache',
+    'cache_info',
+    'warmup_routes',
+    'preload',
     'dispatch'
 ]
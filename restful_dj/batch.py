@@ -0,0 +1,313 @@
+import asyncio
+import copy
+import json
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
+from django.utils.functional import LazyObject, empty
+
+from . import router
+from .pool import BATCH_POOL, PoolFullError, get_pool
+from .util import codec
+from .util import logger
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:
+    # asgiref 随 Django 3.0 及以上版本安装，低版本的 Django 不支持异步的流式响应
+    async_to_sync = None
+
+# 单次批量请求允许的最大子调用数量
+BATCH_MAX_SIZE = 50
+
+# 需要从批量请求复制到子请求的属性(通常由 django 中间件设置)
+BATCH_SHARED_ATTRS = ('user', 'auth', 'session')
+
+
+def _parse_items(request):
+    """
+    解析批量请求的内容
+    :param request:
+    :return: 格式不正确时返回 HttpResponse
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        items = codec.loads(request.body)
+    except Exception as e:
+        return HttpResponseBadRequest('Deserialize batch body fail: %s' % str(e))
+
+    if not isinstance(items, list):
+        return HttpResponseBadRequest('Batch body should be an array')
+
+    if len(items) > BATCH_MAX_SIZE:
+        return HttpResponseBadRequest('Too many batch items, at most %s allowed' % BATCH_MAX_SIZE)
+
+    return items
+
+
+def _get_shared_attrs(request) -> dict:
+    """
+    获取需要复制到子请求的属性
+    子调用会并发执行，因此延迟加载的属性(如 request.user)会在分发前加载，以免在多个线程中同时加载
+    :param request: 批量请求
+    :return: {属性名称: 值}
+    """
+    shared = {}
+    for attr in BATCH_SHARED_ATTRS:
+        if not hasattr(request, attr):
+            continue
+        value = getattr(request, attr)
+        if isinstance(value, LazyObject):
+            # noinspection PyProtectedMember
+            if value._wrapped is empty:
+                # noinspection PyProtectedMember
+                value._setup()
+            # noinspection PyProtectedMember
+            value = value._wrapped
+        shared[attr] = value
+
+    session = shared.get('session')
+    if isinstance(session, SessionBase):
+        # 在分发前加载 session 数据，各子请求使用其副本
+        shared['session'] = _SessionSnapshot(session)
+    return shared
+
+
+class _SessionSnapshot:
+    """
+    批量请求的 session 数据快照
+    session 不是线程安全的，每个子请求使用一个独立的副本，
+    所有子调用完成后，再按子调用的顺序将各副本的修改合并到批量请求的 session 中
+    """
+
+    def __init__(self, session: SessionBase):
+        self.session = session
+        self.data = dict(session.items())
+
+    def fork(self) -> SessionBase:
+        sub_session = copy.copy(self.session)
+        # noinspection PyProtectedMember
+        sub_session._session_cache = copy.deepcopy(self.data)
+        sub_session.modified = False
+        sub_session.accessed = False
+        return sub_session
+
+    def merge(self, sub_session: SessionBase):
+        if sub_session.accessed:
+            self.session.accessed = True
+        if not sub_session.modified:
+            return
+
+        # noinspection PyProtectedMember
+        sub_data = sub_session._session_cache
+        for key in self.data:
+            if key not in sub_data:
+                self.session.pop(key, None)
+        for key, value in sub_data.items():
+            if key not in self.data or self.data[key] != value:
+                self.session[key] = value
+
+
+def _merge_sessions(shared: dict, sub_requests: list):
+    """
+    将子请求对 session 的修改合并到批量请求的 session 中
+    """
+    snapshot = shared.get('session')
+    if not isinstance(snapshot, _SessionSnapshot):
+        return
+    for sub_request in sub_requests:
+        snapshot.merge(sub_request.session)
+
+
+def _create_sub_request(request, item, shared: dict):
+    """
+    根据子调用的描述创建子请求，子请求的参数始终以 json 的形式传递
+    :param request: 批量请求
+    :param item: {method, entry, name, params}
+    :param shared: 需要复制到子请求的属性，由 _get_shared_attrs 获取
+    :return: (子请求, entry, name)，格式不正确时返回错误消息
+    """
+    if not isinstance(item, dict):
+        return 'Batch item should be an object'
+
+    entry = item.get('entry')
+    name = item.get('name') or ''
+    method = item.get('method') or 'GET'
+    params = item.get('params') or {}
+
+    if not entry or not isinstance(entry, str) or not isinstance(name, str) or not isinstance(method, str):
+        return 'Invalid batch item: %s' % json.dumps(item)
+
+    if not isinstance(params, dict):
+        return 'Params of batch item should be an object'
+
+    body = codec.dumps(params)
+
+    sub_request = HttpRequest()
+    sub_request.method = method.upper()
+    # 子请求的地址与批量请求处于同一级
+    sub_request.path = sub_request.path_info = '%s/%s' % (
+        request.path.rstrip('/').rpartition('/')[0],
+        entry if not name else '%s/%s' % (entry, name)
+    )
+    sub_request.COOKIES = request.COOKIES
+    sub_request.META = dict(request.META)
+    sub_request.META.update({
+        'REQUEST_METHOD': sub_request.method,
+        'PATH_INFO': sub_request.path_info,
+        'QUERY_STRING': '',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body))
+    })
+    sub_request.content_type = 'application/json'
+    sub_request.content_params = {}
+    sub_request._body = body
+
+    for attr, value in shared.items():
+        setattr(sub_request, attr, value.fork() if isinstance(value, _SessionSnapshot) else value)
+
+    return sub_request, entry, name
+
+
+def _get_item_result(response: HttpResponse, content: bytes = None) -> dict:
+    """
+    将子调用的响应转换成批量请求的单项结果
+    :param response:
+    :param content: 已读取的响应内容
+    :return: {status, body}
+    """
+    if content is not None:
+        pass
+    elif getattr(response, 'is_async', False):
+        # 同步分发(WSGI)时，异步的流式响应需要在事件循环中读取
+        content = async_to_sync(_read_async_content)(response)
+    elif response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+
+    content_type = response.get('Content-Type', '')
+    if 'application/json' in content_type:
+        try:
+            body = codec.loads(content)
+        except Exception:
+            body = content.decode(response.charset, errors='replace')
+    else:
+        body = content.decode(response.charset, errors='replace')
+
+    return {
+        'status': response.status_code,
+        'body': body
+    }
+
+
+async def _read_async_content(response: HttpResponse) -> bytes:
+    """
+    读取异步的流式响应的全部内容
+    :param response:
+    :return:
+    """
+    return b''.join([chunk async for chunk in response.streaming_content])
+
+
+def _get_error_result(status: int, message: str) -> dict:
+    return {
+        'status': status,
+        'body': message
+    }
+
+
+def _dispatch_item(sub_request, entry, name):
+    # noinspection PyBroadException
+    try:
+        return _get_item_result(router.dispatch(sub_request, entry, name))
+    except Exception as e:
+        # 开发模式时，路由中的异常会被抛出
+        logger.error('[restful-dj]\n\tBatch item "%s/%s" failed' % (entry, name), e, _raise=False)
+        return _get_error_result(500, str(e))
+
+
+def batch(request):
+    """
+    批量请求入口，在一个请求中执行多个路由调用
+    请求体为 [{method, entry, name, params}]，各子调用会在线程池中并发执行
+    :param request:
+    :return: [{status, body}]，顺序与请求一致
+    """
+    items = _parse_items(request)
+    if isinstance(items, HttpResponse):
+        return items
+
+    pool = get_pool(getattr(settings, 'RESTFUL_DJ_BATCH_POOL', BATCH_POOL))
+    shared = _get_shared_attrs(request)
+
+    results = [None] * len(items)
+    futures = []
+    sub_requests = []
+    for index, item in enumerate(items):
+        sub = _create_sub_request(request, item, shared)
+        if isinstance(sub, str):
+            results[index] = _get_error_result(400, sub)
+            continue
+        try:
+            futures.append((index, pool.submit(_dispatch_item, *sub)))
+        except PoolFullError as e:
+            logger.warning(str(e))
+            results[index] = _get_error_result(503, str(e))
+            continue
+        sub_requests.append(sub[0])
+
+    for index, future in futures:
+        results[index] = future.result()
+
+    _merge_sessions(shared, sub_requests)
+
+    return HttpResponse(codec.dumps(results), content_type='application/json')
+
+
+async def _dispatch_item_async(sub_request, entry, name):
+    # noinspection PyBroadException
+    try:
+        response = await router.dispatch_async(sub_request, entry, name)
+        if getattr(response, 'is_async', False):
+            # 异步的流式响应
+            return _get_item_result(response, await _read_async_content(response))
+        return _get_item_result(response)
+    except Exception as e:
+        logger.error('[restful-dj]\n\tBatch item "%s/%s" failed' % (entry, name), e, _raise=False)
+        return _get_error_result(500, str(e))
+
+
+async def batch_async(request):
+    """
+    batch 的异步版本，用于 ASGI
+    各子调用会在事件循环中并发执行，同步的路由处理函数仍在其线程池中执行
+    :param request:
+    :return: [{status, body}]，顺序与请求一致
+    """
+    items = _parse_items(request)
+    if isinstance(items, HttpResponse):
+        return items
+
+    async def error_result(status, message):
+        return _get_error_result(status, message)
+
+    # 加载 user 与 session 可能会访问数据库，在线程池中执行
+    shared = await get_pool(getattr(settings, 'RESTFUL_DJ_BATCH_POOL', BATCH_POOL)).run(_get_shared_attrs, request)
+
+    tasks = []
+    sub_requests = []
+    for item in items:
+        sub = _create_sub_request(request, item, shared)
+        if isinstance(sub, str):
+            tasks.append(error_result(400, sub))
+        else:
+            tasks.append(_dispatch_item_async(*sub))
+            sub_requests.append(sub[0])
+
+    results = await asyncio.gather(*tasks)
+    _merge_sessions(shared, sub_requests)
+    return HttpResponse(codec.dumps(list(results)), content_type='application/json')
@@ -0,0 +1,289 @@
+import copy
+from collections import OrderedDict
+from functools import partial
+
+from django.http import HttpRequest, HttpResponseBadRequest
+from django.utils.datastructures import MultiValueDict
+from django.utils.functional import SimpleLazyObject, empty
+
+from .util import codec
+from .util import converter
+from .util import logger
+from .util.utils import ArgumentSpecification
+from .util.utils import get_func_info
+
+# 从 queryString 中读取参数的请求方法，其它方法从 POST 中读取
+_QUERY_METHODS = ('delete', 'get')
+
+# 参数值转换失败且不需要中止请求，或使用默认值时返回此值(此时不会填充此参数)
+_SKIP = object()
+
+
+def _get_params_dict(request, attr):
+    return getattr(request, attr).dict()
+
+
+class LazyParams(SimpleLazyObject):
+    """
+    request.G / request.P ，首次访问时才会将 request.GET / request.POST 转换成 dict
+    参数绑定时，若其未被访问过，会直接从 QueryDict 中取值，不进行复制
+    多值参数(如 ?id=1&id=2)始终从 QueryDict 中读取，与其是否被访问过无关
+    """
+
+    def __init__(self, request, attr: str):
+        """
+
+        :param request:
+        :param attr: GET 或 POST
+        """
+        self.__dict__['_source'] = (request, attr)
+        super().__init__(partial(_get_params_dict, request, attr))
+
+    @property
+    def is_loaded(self) -> bool:
+        """
+        是否已被访问过(已转换成 dict)
+        """
+        return self._wrapped is not empty
+
+    def get_query_dict(self):
+        """
+        获取原始的 QueryDict (request.GET 或 request.POST)
+        :return:
+        """
+        request, attr = self._source
+        return getattr(request, attr)
+
+    def __copy__(self):
+        if self._wrapped is empty:
+            return type(self)(*self._source)
+        return copy.copy(self._wrapped)
+
+
+class _BindError(Exception):
+    """
+    参数绑定失败，其消息会作为 400 响应的内容
+    """
+    pass
+
+
+def _get_parameter_str(args: OrderedDict):
+    return '\n\t\t'.join([str(args[arg]) for arg in args])
+
+
+def _compile_converter(func, arg_name: str, arg_spec: ArgumentSpecification, args: OrderedDict):
+    """
+    根据参数的类型声明，生成类型转换函数
+    :return: 未声明类型时返回 None
+    """
+    if not arg_spec.has_annotation:
+        return None
+
+    annotation = arg_spec.annotation
+
+    def mismatch(arg_value):
+        msg = 'Argument type of "%s" mismatch, expect type "%s" but got "%s", signature: (%s)' \
+              % (arg_name, converter.get_type_name(annotation), type(arg_value).__name__, _get_parameter_str(args))
+        logger.warning(msg)
+        return _BindError(msg)
+
+    # 当 arg_value 是字符串，arg_spec的类型是对象时，尝试解析成 json
+    if annotation in (dict, list):
+        def convert_json(arg_value):
+            if arg_value is None or isinstance(arg_value, annotation):
+                return arg_value
+            # noinspection PyBroadException
+            try:
+                if isinstance(arg_value, str):
+                    # noinspection PyBroadException
+                    try:
+                        arg_value = codec.loads(arg_value)
+                    except Exception:
+                        # 此处的异常直接忽略即可
+                        logger.warning('Value for "%s!%s" may be incorrect: %s' % (func.__name__, arg_name, arg_value))
+
+                    # 类型一致，直接使用
+                    if isinstance(arg_value, annotation):
+                        return arg_value
+                return annotation(arg_value)
+            except Exception:
+                raise mismatch(arg_value)
+
+        return convert_json
+
+    # 其它类型使用已注册的转换函数
+    convert_value = converter.compile_converter(annotation)
+    if convert_value is None:
+        return None
+
+    def convert(arg_value):
+        # 当值为 None 时，不作数据类型校验
+        if arg_value is None:
+            return arg_value
+        result = convert_value(arg_value)
+        if result is converter.INVALID:
+            raise mismatch(arg_value)
+        return result
+
+    return convert
+
+
+def _compile_getter(func, arg_name: str, arg_spec: ArgumentSpecification, args: OrderedDict):
+    """
+    生成单个参数的取值函数，其参数依次为: 参数来源(G 或 P ，或其 QueryDict), 原始的 QueryDict, request.B
+    """
+    alias = arg_spec.alias
+    keys = (arg_name,) if alias is None else (arg_name, alias)
+    has_default = arg_spec.has_default
+    convert = _compile_converter(func, arg_name, arg_spec, args)
+    # 列表等类型的参数，从 QueryDict 中取值时，读取同名参数的所有值(如 ?id=1&id=2)
+    multiple = arg_spec.has_annotation and converter.is_multiple(arg_spec.annotation)
+
+    def get_value(arg_source: dict, query_dict: MultiValueDict, body: dict):
+        for key in keys:
+            if key in arg_source:
+                # 参数来源中的 dict 只保留了每个参数的最后一个值，多值需要从 QueryDict 中读取
+                if multiple and query_dict is not None and key in query_dict:
+                    values = query_dict.getlist(key)
+                    arg_value = values[0] if len(values) == 1 else values
+                else:
+                    arg_value = arg_source[key]
+                break
+        else:
+            for key in keys:
+                if key in body:
+                    arg_value = body[key]
+                    break
+            else:
+                # 使用默认值: 不填充此参数，由 python 使用函数声明中的默认值
+                # 不使用参数列表中记录的默认值，其可能来自已过期的路由映射文件
+                if has_default:
+                    return _SKIP
+
+                # 缺少无默认值的参数
+                msg = '%s\n\tMissing required argument "%s":\n\t\t%s' % (
+                    get_func_info(func),
+                    arg_name,
+                    _get_parameter_str(args)
+                )
+                logger.warning(msg)
+                raise _BindError(msg)
+
+        return arg_value if convert is None else convert(arg_value)
+
+    return get_value
+
+
+class ArgumentBinder:
+    """
+    路由处理函数的参数绑定器
+    在路由注册时根据参数声明编译一次，请求时直接按编译好的步骤从 G/P/B 中取值
+    """
+
+    __slots__ = ('func', 'args', '_request_args', '_value_args', '_used_args', '_has_variable_args')
+
+    def __init__(self, func, args: OrderedDict):
+        """
+
+        :param func: 路由处理函数
+        :param args: 路由处理函数的参数列表
+        """
+        self.func = func
+        self.args = args
+
+        # 需要传入 HttpRequest 对象的参数名称
+        request_args = []
+        # 需要从请求数据中取值的参数: (参数名称, 取值函数)
+        value_args = []
+        # 是否声明了可变参数
+        has_variable_args = False
+
+        for arg_name, arg_spec in args.items():
+            # 如果是可变参数：如: **kwargs
+            # 设置标记，以在后面进行填充
+            if arg_spec.is_variable:
+                has_variable_args = True
+                continue
+
+            # 以下情况将传入 HttpRequest 对象
+            # 1. 当参数名称是 request 并且未指定类型
+            # 2. 当参数类型是 HttpRequest 时 (不论参数名称，包括 request)
+            # 但是，参数名称是 request 但其类型不是 HttpRequest ，就会被当作一般参数处理
+            if (arg_name == 'request' and not arg_spec.has_annotation) or arg_spec.annotation == HttpRequest:
+                request_args.append(arg_name)
+                continue
+
+            value_args.append((arg_name, _compile_getter(func, arg_name, arg_spec, args)))
+
+        self._request_args = tuple(request_args)
+        self._value_args = tuple(value_args)
+        # 已使用的参数名称，用于填充可变参数时作排除用
+        self._used_args = frozenset(item[0] for item in value_args)
+        self._has_variable_args = has_variable_args
+
+    @property
+    def request_args(self) -> tuple:
+        """
+        需要传入 HttpRequest 对象的参数名称
+        """
+        return self._request_args
+
+    def bind(self, request: HttpRequest) -> dict or HttpResponseBadRequest:
+        """
+        从请求中获取路由处理函数的实参
+        :param request:
+        :return: 参数不合法时返回 HttpResponseBadRequest
+        """
+        actual_args = {}
+
+        for arg_name in self._request_args:
+            actual_args[arg_name] = request
+
+        # 不需要从请求数据中取值时，不访问 G/P/B ，以避免解析请求数据
+        if not self._value_args and not self._has_variable_args:
+            return actual_args
+
+        # request.B/G/P 是延迟对象，取值函数仅在参数来源中找不到参数时才会访问 request.B
+        # noinspection PyUnresolvedReferences
+        arg_source = request.G if request.method.lower() in _QUERY_METHODS else request.P
+        if type(arg_source) is LazyParams:
+            query_dict = arg_source.get_query_dict()
+            # 未被访问过(也未被修改过)时，直接从 QueryDict 中取值
+            if not arg_source.is_loaded:
+                arg_source = query_dict
+        elif isinstance(arg_source, MultiValueDict):
+            query_dict = arg_source
+        else:
+            query_dict = None
+        # noinspection PyUnresolvedReferences
+        body = request.B
+
+        # 转换失败但不中止请求的参数，以及使用默认值的参数，不会被填充
+        skipped = None
+        try:
+            for arg_name, get_value in self._value_args:
+                arg_value = get_value(arg_source, query_dict, body)
+                if arg_value is _SKIP:
+                    if skipped is None:
+                        skipped = set()
+                    skipped.add(arg_name)
+                    continue
+                actual_args[arg_name] = arg_value
+        except _BindError as e:
+            return HttpResponseBadRequest(e.args[0])
+
+        if not self._has_variable_args:
+            return actual_args
+
+        used_args = self._used_args if skipped is None else self._used_args - skipped
+
+        # 填充可变参数，需要合并所有的参数来源
+        for item in arg_source:
+            if item not in used_args:
+                actual_args[item] = arg_source[item]
+
+        for item in body:
+            if item not in used_args:
+                actual_args[item] = body[item]
+
+        return actual_args
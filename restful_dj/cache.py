@@ -0,0 +1,512 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+from .meta import RouteMeta
+from .util import logger
+
+# 缓存的默认配置，可以通过 @route(cache={...}) 修改
+# ttl: 缓存的有效时长(秒)，为 0 时不过期
+# max_entries: 每个路由最多缓存的响应数量，超出时淘汰最久未使用的响应
+# key: 生成缓存键的函数，其参数为 (request, args)，返回 None 时不使用缓存
+# backend: 缓存的存储名称，未指定时使用 settings.RESTFUL_DJ_CACHE_BACKEND ，其默认值为 memory
+DEFAULT_CACHE = {
+    'ttl': 60,
+    'max_entries': 1000,
+    'key': None,
+    'backend': None
+}
+
+# 进程内的缓存存储名称
+MEMORY_BACKEND = 'memory'
+
+# 同一主机上的多个进程共享的缓存存储名称(SQLite)
+SQLITE_BACKEND = 'sqlite'
+
+# 已注册的缓存存储
+CACHE_BACKENDS = {}
+
+_BACKENDS_LOCK = Lock()
+
+# 已启用缓存的路由: {route_id: RouteCache}
+ROUTE_CACHES = {}
+
+
+class CacheBackend:
+    """
+    路由响应缓存的存储，缓存的数据为 (状态码, 响应头列表, 响应内容)
+    自定义存储需要继承此类，并通过 restful_dj.register_cache_backend 注册
+    """
+
+    # 读写是否会阻塞(如文件或网络 I/O)，为 True 时，异步分发(ASGI)中会在线程中读写，以免阻塞事件循环
+    blocking = True
+
+    def get(self, route_id: str, key: str):
+        """
+        获取缓存的数据
+        :param route_id: 路由标识
+        :param key: 缓存键
+        :return: 未命中或已过期时返回 None
+        """
+        raise NotImplementedError()
+
+    def set(self, route_id: str, key: str, value: tuple, ttl: int, max_entries: int):
+        """
+        缓存数据
+        :param route_id: 路由标识
+        :param key: 缓存键
+        :param value: (状态码, 响应头列表, 响应内容)
+        :param ttl: 有效时长(秒)，为 0 时不过期
+        :param max_entries: 此路由最多缓存的数量
+        :return:
+        """
+        raise NotImplementedError()
+
+    def clear(self, route_id: str = None):
+        """
+        清除缓存
+        :param route_id: 为 None 时清除所有路由的缓存
+        :return:
+        """
+        raise NotImplementedError()
+
+    def size(self, route_id: str) -> int:
+        """
+        获取路由已缓存的数量
+        """
+        raise NotImplementedError()
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    进程内的缓存存储，每个路由使用一个 LRU 队列
+    """
+
+    blocking = False
+
+    def __init__(self):
+        self._lock = Lock()
+        # {route_id: {缓存键: (过期时间, 数据)}}
+        self._routes = {}
+
+    def get(self, route_id: str, key: str):
+        with self._lock:
+            entries = self._routes.get(route_id)
+            entry = None if entries is None else entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return value
+
+    def set(self, route_id: str, key: str, value: tuple, ttl: int, max_entries: int):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            entries = self._routes.get(route_id)
+            if entries is None:
+                entries = self._routes[route_id] = OrderedDict()
+            entries[key] = (expires, value)
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    def clear(self, route_id: str = None):
+        with self._lock:
+            if route_id is None:
+                self._routes.clear()
+            else:
+                self._routes.pop(route_id, None)
+
+    def size(self, route_id: str) -> int:
+        entries = self._routes.get(route_id)
+        return 0 if entries is None else len(entries)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    使用本地 SQLite 文件(WAL 模式)的缓存存储，同一主机上的多个进程(如 gunicorn 的 worker)共享缓存
+    超出 max_entries 时，按写入时间淘汰最早的数据，淘汰每隔 EVICT_INTERVAL 次写入执行一次，因此数量限制是近似的
+    """
+
+    # 每个路由在每个进程中写入多少次后，执行一次淘汰
+    EVICT_INTERVAL = 100
+
+    # 缓存键超过此长度时，使用其摘要
+    MAX_KEY_LENGTH = 200
+
+    def __init__(self, path: str, timeout: float = 5):
+        """
+
+        :param path: SQLite 文件路径
+        :param timeout: 等待其它进程写入完成的最长时间(秒)
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = {}
+        self._lock = Lock()
+
+    def _connect(self):
+        # 每个线程使用独立的连接，fork 之后需要重新连接
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS route_cache ('
+            'route_id TEXT NOT NULL, key TEXT NOT NULL, expires REAL, created REAL NOT NULL, '
+            'status INTEGER NOT NULL, headers TEXT NOT NULL, content BLOB NOT NULL, '
+            'PRIMARY KEY (route_id, key))'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS route_cache_created ON route_cache (route_id, created)')
+        local.conn = conn
+        local.pid = os.getpid()
+        return conn
+
+    def _get_key(self, key) -> str:
+        key = str(key)
+        if len(key) <= self.MAX_KEY_LENGTH:
+            return key
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, route_id: str, key: str):
+        row = self._connect().execute(
+            'SELECT expires, status, headers, content FROM route_cache WHERE route_id = ? AND key = ?',
+            (route_id, self._get_key(key))
+        ).fetchone()
+        if row is None:
+            return None
+        expires, status, headers, content = row
+        if expires is not None and expires <= time.time():
+            return None
+        return status, json.loads(headers), content
+
+    def set(self, route_id: str, key: str, value: tuple, ttl: int, max_entries: int):
+        now = time.time()
+        status, headers, content = value
+        conn = self._connect()
+        conn.execute(
+            'INSERT OR REPLACE INTO route_cache (route_id, key, expires, created, status, headers, content) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (route_id, self._get_key(key), now + ttl if ttl else None, now, status, json.dumps(headers), content)
+        )
+
+        with self._lock:
+            writes = self._writes.get(route_id, 0) + 1
+            self._writes[route_id] = writes
+        if writes % self.EVICT_INTERVAL == 0:
+            self._evict(conn, route_id, max_entries, now)
+
+    @staticmethod
+    def _evict(conn, route_id: str, max_entries: int, now: float):
+        conn.execute('DELETE FROM route_cache WHERE route_id = ? AND expires <= ?', (route_id, now))
+        conn.execute(
+            'DELETE FROM route_cache WHERE route_id = ? AND created < ('
+            'SELECT created FROM route_cache WHERE route_id = ? ORDER BY created DESC LIMIT 1 OFFSET ?)',
+            (route_id, route_id, max_entries - 1)
+        )
+
+    def clear(self, route_id: str = None):
+        conn = self._connect()
+        if route_id is None:
+            conn.execute('DELETE FROM route_cache')
+        else:
+            conn.execute('DELETE FROM route_cache WHERE route_id = ?', (route_id,))
+
+    def size(self, route_id: str) -> int:
+        return self._connect().execute('SELECT COUNT(*) FROM route_cache WHERE route_id = ?', (route_id,)).fetchone()[0]
+
+
+def _get_sqlite_path() -> str:
+    """
+    共享缓存的默认文件路径，可以通过 settings.RESTFUL_DJ_CACHE_PATH 指定
+    未指定时，在临时目录中根据项目路径生成，以免与同一主机上的其它项目冲突
+    """
+    path = getattr(settings, 'RESTFUL_DJ_CACHE_PATH', None)
+    if path:
+        return path
+    project = hashlib.sha1(str(getattr(settings, 'BASE_DIR', '')).encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'restful_dj_cache_%s.sqlite3' % project)
+
+
+def register_cache_backend(name: str, backend: CacheBackend):
+    """
+    注册缓存存储，路由可以通过 @route(cache={'backend': 'name'}) 指定使用的存储
+    :param name: 存储名称，为 memory 或 sqlite 时替换内置的存储
+    :param backend:
+    :return:
+    """
+    with _BACKENDS_LOCK:
+        CACHE_BACKENDS[name] = backend
+
+
+def get_cache_backend(name: str = None) -> CacheBackend:
+    """
+    获取缓存存储，内置的存储未注册时，会自动创建
+    :param name: 为 None 时使用 settings.RESTFUL_DJ_CACHE_BACKEND ，其默认值为 memory
+    :return:
+    """
+    if name is None:
+        name = getattr(settings, 'RESTFUL_DJ_CACHE_BACKEND', MEMORY_BACKEND)
+
+    backend = CACHE_BACKENDS.get(name)
+    if backend is not None:
+        return backend
+
+    if name not in (MEMORY_BACKEND, SQLITE_BACKEND):
+        raise Exception(
+            '[restful-dj] Cache backend "%s" not registered, did you forgot to call `restful_dj.register_cache_backend`'
+            % name)
+
+    with _BACKENDS_LOCK:
+        backend = CACHE_BACKENDS.get(name)
+        if backend is None:
+            if name == MEMORY_BACKEND:
+                backend = MemoryCacheBackend()
+            else:
+                backend = SQLiteCacheBackend(_get_sqlite_path())
+            CACHE_BACKENDS[name] = backend
+    return backend
+
+
+# repr 只取决于值的类型
+_PLAIN_TYPES = (str, bytes, int, float, type(None))
+
+
+class _UnstableValue(Exception):
+    """
+    参数值的 repr 依赖于对象的内存地址，无法生成稳定的缓存键
+    """
+    pass
+
+
+def _freeze(value):
+    """
+    将参数值转换成可以稳定表示的形式
+    容器会转换成带类型标记的元组，如: {'a': 1} 转换成 ('d', (('a', 1),)) ，[['a', 1]] 转换成 ('l', (('l', ('a', 1)),))
+    以免不同类型的值生成相同的缓存键；字典与集合按其元素的 repr 排序
+    """
+    if isinstance(value, dict):
+        items = [(_freeze(key), _freeze(item)) for key, item in value.items()]
+        return 'd', tuple(sorted(items, key=lambda pair: repr(pair[0])))
+    if isinstance(value, list):
+        return 'l', tuple(_freeze(item) for item in value)
+    if isinstance(value, tuple):
+        return 't', tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return 's', tuple(sorted((_freeze(item) for item in value), key=repr))
+    if isinstance(value, _PLAIN_TYPES):
+        return value
+    # 如: <Foo object at 0x...> 、<function foo at 0x...>
+    if type(value).__repr__ is object.__repr__ or ' at 0x' in repr(value):
+        raise _UnstableValue()
+    return value
+
+
+def make_key(route_id: str, args: dict):
+    """
+    根据路由标识与绑定后的参数生成默认的缓存键
+    :param route_id:
+    :param args: 路由处理函数的实参(不包括 HttpRequest 对象)
+    :return: 参数值无法稳定表示时(如未实现 __repr__ 的对象)返回 None ，此时不使用缓存
+    """
+    try:
+        return '%s:%r' % (route_id, _freeze(args))
+    except _UnstableValue:
+        return None
+
+
+class RouteCache:
+    """
+    单个路由的响应缓存，缓存的是序列化后的响应(状态码、响应头与内容)
+    命中时不再调用路由处理函数、process_return 以及序列化
+    """
+
+    def __init__(self, meta: RouteMeta, options: dict, request_args: tuple):
+        """
+
+        :param meta: 路由元数据
+        :param options: @route(cache={...}) 的值
+        :param request_args: 传入 HttpRequest 对象的参数名称，不参与生成缓存键
+        """
+        self.route_id = meta.id
+        self.ttl = options['ttl']
+        self.max_entries = options['max_entries']
+        self.backend = get_cache_backend(options['backend'])
+        self._key_func = options['key']
+        self._request_args = request_args
+        self._lock = Lock()
+        # 命中次数与未命中次数(当前进程)
+        self._hits = 0
+        self._misses = 0
+
+    def get_key(self, request: HttpRequest, args: dict):
+        """
+        生成缓存键
+        :return: 为 None 时不使用缓存
+        """
+        if self._request_args:
+            args = {name: value for name, value in args.items() if name not in self._request_args}
+
+        if self._key_func is not None:
+            return self._key_func(request, args)
+
+        return make_key(self.route_id, args)
+
+    def get(self, key):
+        """
+        获取缓存的响应
+        :param key:
+        :return: 未命中时返回 None
+        """
+        # noinspection PyBroadException
+        try:
+            value = self.backend.get(self.route_id, key)
+        except Exception as e:
+            # 缓存不可用时，按未命中处理
+            logger.warning('[restful-dj] Read cache of "%s" failed: %s' % (self.route_id, str(e)))
+            value = None
+
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+
+        return _to_response(value)
+
+    async def get_async(self, key, run_sync):
+        """
+        get 的异步版本，存储的读写会阻塞时，在线程中读取
+        :param key:
+        :param run_sync: 执行同步函数的方式
+        :return:
+        """
+        if not self.backend.blocking:
+            return self.get(key)
+        return await run_sync(self.get, key)
+
+    def set(self, key, response: HttpResponse):
+        """
+        缓存响应，仅缓存状态码为 200 的非流式响应
+        :param key:
+        :param response:
+        :return:
+        """
+        if not _is_cacheable(response):
+            return
+
+        value = (response.status_code, list(response.items()), response.content)
+        # noinspection PyBroadException
+        try:
+            self.backend.set(self.route_id, key, value, self.ttl, self.max_entries)
+        except Exception as e:
+            logger.warning('[restful-dj] Write cache of "%s" failed: %s' % (self.route_id, str(e)))
+
+    async def set_async(self, key, response: HttpResponse, run_sync):
+        """
+        set 的异步版本，存储的读写会阻塞时，在线程中写入
+        :param key:
+        :param response:
+        :param run_sync: 执行同步函数的方式
+        :return:
+        """
+        if not self.backend.blocking:
+            self.set(key, response)
+        elif _is_cacheable(response):
+            await run_sync(self.set, key, response)
+
+    def clear(self):
+        self.backend.clear(self.route_id)
+
+    def info(self) -> dict:
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'size': self.backend.size(self.route_id),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl
+        }
+
+
+def _is_cacheable(response: HttpResponse) -> bool:
+    # 仅缓存状态码为 200 、未设置 cookie 的非流式响应
+    return response.status_code == 200 and not response.streaming and not response.cookies
+
+
+def _to_response(value) -> HttpResponse:
+    status, headers, content = value
+    response = HttpResponse(content, status=status)
+    for name, header in headers:
+        response[name] = header
+    return response
+
+
+def create_route_cache(meta: RouteMeta, request_args: tuple):
+    """
+    根据 @route(cache=...) 创建路由的响应缓存
+    :param meta:
+    :param request_args: 传入 HttpRequest 对象的参数名称
+    :return: 未启用缓存时返回 None
+    """
+    options = meta.get('cache')
+    if not options:
+        return None
+
+    options = DEFAULT_CACHE if not isinstance(options, dict) else dict(DEFAULT_CACHE, **options)
+    route_cache = ROUTE_CACHES[meta.id] = RouteCache(meta, options, request_args)
+    return route_cache
+
+
+def invalidate_cache(route=None, backend: str = None):
+    """
+    清除路由的响应缓存，使用共享的缓存存储时，同一主机上所有进程的缓存都会被清除
+    :param route: 路由标识(route_id)或路由处理函数，为 None 时清除所有路由的缓存
+    :param backend: 缓存存储名称，为 None 时清除默认存储、路由声明的存储以及当前进程已使用的所有存储
+    :return:
+    """
+    options = None
+    if route is not None:
+        meta = getattr(route, 'route_meta', None)
+        if meta is not None:
+            options = meta.get('cache')
+            route = meta.id
+
+    if backend is not None:
+        get_cache_backend(backend).clear(route)
+        return
+
+    # 路由在当前进程中可能尚未被调用过(如管理命令)，因此除了已使用的存储，还需要清除默认存储与路由声明的存储
+    backends = [get_cache_backend()]
+    if isinstance(options, dict) and options.get('backend') is not None:
+        backends.append(get_cache_backend(options['backend']))
+    for cache_backend in list(CACHE_BACKENDS.values()):
+        if cache_backend not in backends:
+            backends.append(cache_backend)
+
+    for cache_backend in backends:
+        cache_backend.clear(route)
+
+
+def cache_info() -> dict:
+    """
+    获取各路由的缓存统计信息，命中次数与未命中次数为当前进程的统计
+    :return: {route_id: {hits, misses, size, max_entries, ttl}}
+    """
+    return {route_id: route_cache.info() for route_id, route_cache in ROUTE_CACHES.items()}
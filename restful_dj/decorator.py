@@ -1,14 +1,31 @@
-import json
-from collections import OrderedDict
-from functools import wraps
+import asyncio
+import inspect
+from collections.abc import Iterator
+from functools import partial, wraps
 
-from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, HttpRequest
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, HttpRequest
+from django.utils.functional import SimpleLazyObject
 
+from .binder import ArgumentBinder, LazyParams
 from .meta import RouteMeta
 from .middleware import MiddlewareManager
+from . import cache
+from . import queryset
+from . import streaming
+from .pool import DEFAULT_POOL, check_pool, get_pool
+from .util import codec
 from .util import logger
-from .util.utils import ArgumentSpecification
-from .util.utils import get_func_info
+
+try:
+    from asgiref.sync import async_to_sync, sync_to_async
+except ImportError:
+    # asgiref 随 Django 3.0 及以上版本安装，低版本的 Django 不支持异步的路由处理函数
+    async_to_sync = sync_to_async = None
+
+# 路由处理函数被其它装饰器包装时，路由分发会调用最外层的函数，以免跳过这些装饰器
+# 此时传入的参数为 (request, _ROUTE_CALL)
+_ROUTE_CALL = object()
 
 
 def route(module=None, name=None, **kwargs):
@@ -22,49 +39,139 @@ def route(module=None, name=None, **kwargs):
         pass
     """
 
+    # 流式响应的编码方式
+    streaming.check_stream_mode(kwargs.get('stream'))
+
     def invoke_route(func):
-        @wraps(func)
-        def caller(*args):
-            # 参数长度不为 2 时，认为是用户调用
-            if len(args) != 2:
-                return func(*args)
-
-            # Http 请求对象
-            # :type HttpRequest
-            request = args[0]
-            # 函数声明时定义的参数列表
-            # :type OrderedDict
-            func_args = args[1]
-
-            # 如果传入的参数第一个不是 request，第二个不是 OrderedDict，
-            # 那么就认为是用户调用，而不是路由调用
-            # 此时直接将原参数传给 func 进行调用
-            if not isinstance(request, HttpRequest) or not isinstance(func_args, OrderedDict):
-                return func(*args)
-
-            meta = RouteMeta(
-                func,
-                func_args,
-                route_id='%s_%s' % (func.__module__.replace('_', '__').replace('.', '_'), func.__name__),
-                module=module,
-                name=name,
-                kwargs=kwargs,
-            )
-
-            return _invoke_with_route(request, meta)
+        # 路由元数据，在装饰时创建一次，所有请求共用
+        meta = RouteMeta(
+            func,
+            route_id='%s_%s' % (func.__module__.replace('_', '__').replace('.', '_'), func.__name__),
+            module=module,
+            name=name,
+            kwargs=kwargs,
+        )
+
+        # 参数绑定器，在首次路由调用时根据参数列表编译
+        binder = None
+        # 响应缓存，@route(cache=...) 时，在首次路由调用时创建
+        route_cache = None
+
+        # 是否是异步(async def)的路由处理函数
+        is_async = asyncio.iscoroutinefunction(func)
+
+        if is_async:
+            @wraps(func)
+            async def caller(*args, **kw):
+                # 经过外层的装饰器后，由路由分发调用
+                if len(args) == 2 and args[1] is _ROUTE_CALL:
+                    return await _invoke_with_route_async(args[0], meta, binder or route_prepare(), run_sync,
+                                                          route_cache)
+                # 直接调用时，认为是用户调用，直接将原参数传给 func 进行调用
+                return await func(*args, **kw)
+        else:
+            @wraps(func)
+            def caller(*args, **kw):
+                # 经过外层的装饰器后，由路由分发调用
+                if len(args) == 2 and args[1] is _ROUTE_CALL:
+                    return route_invoke(args[0])
+                # 直接调用时，认为是用户调用，直接将原参数传给 func 进行调用
+                return func(*args, **kw)
+
+        def route_prepare():
+            """
+            预先生成路由调用所需的数据(参数列表、参数绑定器、中间件、响应缓存)，否则会在首次调用时生成
+            :return: 参数绑定器
+            """
+            nonlocal binder, route_cache
+            if binder is None:
+                check_pool(meta.get('pool'))
+                route_binder = ArgumentBinder(func, meta.func_args)
+                MiddlewareManager.prepare(meta)
+                route_cache = cache.create_route_cache(meta, route_binder.request_args)
+                binder = route_binder
+            return binder
+
+        def route_invoke(request: HttpRequest, handler=None):
+            """
+            路由调用入口，由路由分发时调用
+            :param request: Http 请求对象
+            :param handler: 路由分发得到的函数，路由处理函数被其它装饰器包装时，为最外层的函数
+            :return:
+            """
+            outer = None if handler is None or handler is caller else handler
+            # 在同步的分发中调用异步的路由处理函数
+            if is_async:
+                if outer is not None:
+                    return async_to_sync(_invoke_outer_async)(outer, request)
+                return async_to_sync(_invoke_async)(request)
+            if outer is not None:
+                return outer(request, _ROUTE_CALL)
+            return _invoke_with_route(request, meta, binder or route_prepare(), route_cache)
+
+        # 在异步分发中执行同步函数(路由处理函数与中间件函数)的方式
+        # 1. @route(..., thread_sensitive=True) 时，在 Django 的同一个线程中执行(asgiref 的 thread_sensitive 模式)
+        # 2. @route(..., pool='name') 时，在通过 restful_dj.register_pool 注册的线程池中执行
+        # 3. 否则在默认线程池中执行
+        pool_name = meta.get('pool', DEFAULT_POOL)
+
+        def run_in_pool(fn, *args):
+            return get_pool(pool_name).run(fn, *args)
+
+        run_sync = _run_thread_sensitive if meta.get('thread_sensitive') else run_in_pool
+
+        async def _invoke_async(request: HttpRequest):
+            # 同步的路由处理函数，在线程中执行，以免阻塞事件循环
+            if not is_async:
+                return await run_sync(route_invoke, request)
+            return await _invoke_with_route_async(request, meta, binder or route_prepare(), run_sync, route_cache)
+
+        async def route_invoke_async(request: HttpRequest, handler=None):
+            """
+            异步的路由调用入口，由异步的路由分发(ASGI)调用
+            :param request: Http 请求对象
+            :param handler: 路由分发得到的函数，路由处理函数被其它装饰器包装时，为最外层的函数
+            :return:
+            """
+            outer = None if handler is None or handler is caller else handler
+            if outer is None:
+                response = await _invoke_async(request)
+            elif is_async:
+                response = await _invoke_outer_async(outer, request)
+            else:
+                # 外层的装饰器与同步的路由处理函数在同一个线程中执行
+                response = await run_sync(outer, request, _ROUTE_CALL)
+            # 流式响应的同步迭代器同样在线程中读取
+            # 读取可能持续很久(如 SSE)，因此始终在线程池中读取，以免长时间占用 Django 的共享线程
+            return streaming.to_async_response(response, run_in_pool)
+
+        # 路由元数据，同时用于标记此函数是路由处理函数
+        caller.route_meta = meta
+        caller.route_prepare = route_prepare
+        caller.route_invoke = route_invoke
+        caller.route_invoke_async = route_invoke_async
 
         return caller
 
     return invoke_route
 
 
-def _invoke_with_route(request: HttpRequest, meta: RouteMeta):
+async def _invoke_outer_async(outer, request: HttpRequest):
+    """
+    经过外层的装饰器调用异步的路由处理函数，外层的装饰器可能是同步函数(返回协程)
+    """
+    result = outer(request, _ROUTE_CALL)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def _invoke_with_route(request: HttpRequest, meta: RouteMeta, binder: ArgumentBinder, route_cache=None):
     mgr = MiddlewareManager(
         request,
         meta
     )
 
-    func_args = meta.func_args
     func = meta.handler
 
     # 调用中间件，以处理请求
@@ -94,233 +201,179 @@ def _invoke_with_route(request: HttpRequest, meta: RouteMeta):
         return mgr.end(result)
 
     # 调用路由处理函数
-    arg_len = len(func_args)
-    if arg_len == 0:
-        return mgr.end(_wrap_http_response(mgr, func()))
+    # 参数自动从 queryString, POST 或 json 中获取
+    actual_args = binder.bind(request)
+
+    if isinstance(actual_args, HttpResponse):
+        return mgr.end(actual_args)
+
+    # 命中缓存时，不再调用路由处理函数
+    cache_key = None
+    if route_cache is not None:
+        cache_key = route_cache.get_key(request, actual_args)
+        if cache_key is not None:
+            response = route_cache.get(cache_key)
+            if response is not None:
+                return mgr.end(response)
+
+    result = func(**actual_args)
+
+    # 对返回的 QuerySet 进行分页
+    if isinstance(result, QuerySet):
+        result = queryset.apply_paging(request, meta, result)
+        if isinstance(result, HttpResponse):
+            return mgr.end(result)
+
+    response = _wrap_http_response(mgr, result)
+    if cache_key is not None:
+        route_cache.set(cache_key, response)
+
+    return mgr.end(response)
+
+
+async def _run_thread_sensitive(func, *args):
+    return await sync_to_async(func, thread_sensitive=True)(*args)
 
-    # 有参数，自动从 queryString, POST 或 json 中获取
-    # 匹配参数
 
-    actual_args = _get_actual_args(request, func, func_args)
+async def _invoke_with_route_async(request: HttpRequest, meta: RouteMeta, binder: ArgumentBinder, run_sync,
+                                   route_cache=None):
+    """
+    以异步方式调用路由，与 _invoke_with_route 的流程一致，中间件函数与路由处理函数均可以是异步的
+    :param run_sync: 执行同步中间件函数的方式
+    :param route_cache: 响应缓存
+    """
+    mgr = MiddlewareManager(
+        request,
+        meta,
+        run_sync
+    )
+
+    func = meta.handler
+
+    # 调用中间件，以处理请求
+    result = await mgr.begin_async()
+
+    # 返回了 HttpResponse，直接返回此对象
+    if isinstance(result, HttpResponse):
+        return await mgr.end_async(result)
+
+    # 返回了 False，表示未授权访问
+    if result is False:
+        return await mgr.end_async(HttpResponseUnauthorized())
+
+    # 处理请求中的json参数
+    # noinspection PyTypeChecker
+    _process_json_params(request)
+
+    result = await mgr.before_invoke_async()
+
+    # 返回了 False，表示未授权访问
+    if result is False:
+        return await mgr.end_async(HttpResponseUnauthorized())
+
+    # 返回了 HttpResponse ， 直接返回此对象
+    if isinstance(result, HttpResponse):
+        return await mgr.end_async(result)
+
+    # 调用路由处理函数
+    # 参数自动从 queryString, POST 或 json 中获取
+    actual_args = binder.bind(request)
 
     if isinstance(actual_args, HttpResponse):
-        return mgr.end(actual_args)
+        return await mgr.end_async(actual_args)
+
+    # 命中缓存时，不再调用路由处理函数
+    cache_key = None
+    if route_cache is not None:
+        cache_key = route_cache.get_key(request, actual_args)
+        if cache_key is not None:
+            response = await route_cache.get_async(cache_key, run_sync)
+            if response is not None:
+                return await mgr.end_async(response)
 
     result = func(**actual_args)
+    if inspect.isawaitable(result):
+        result = await result
+
+    # 对返回的 QuerySet 进行分页
+    if isinstance(result, QuerySet):
+        result = queryset.apply_paging(request, meta, result)
+        if isinstance(result, HttpResponse):
+            return await mgr.end_async(result)
+
+    response = await _wrap_http_response_async(mgr, result)
+    if cache_key is not None:
+        await route_cache.set_async(cache_key, response, run_sync)
 
-    return mgr.end(_wrap_http_response(mgr, result))
+    return await mgr.end_async(response)
 
 
 def _process_json_params(request):
     """
     参数处理
+    request.B/G/P 均为延迟对象，在首次访问时才会解析，不需要请求参数的路由不会读取请求体
     :return:
     """
-    request.B = {}
-    request.G = {}
-    request.P = {}
-
     if request.content_type is None or 'application/json' not in request.content_type:
-        request.G = request.GET.dict()
-        request.P = request.POST.dict()
+        request.B = {}
+        request.G = LazyParams(request, 'GET')
+        request.P = LazyParams(request, 'POST')
         return
 
-    # 如果请求是json类型，就先处理一下
+    # 如果请求是json类型，在访问时再解析请求体
+    request.B = SimpleLazyObject(partial(_load_json_body, request))
+    request.G = {}
+    request.P = {}
+
 
+def _load_json_body(request):
     body = request.body
 
     if body == '' or body is None:
-        return
+        return {}
 
     try:
-        if isinstance(body, str):
-            request.B = json.loads(body)
-        elif isinstance(body, bytes):
-            request.B = json.loads(body.decode())
+        if isinstance(body, (str, bytes)):
+            return codec.loads(body)
         elif isinstance(body, (dict, list)):
-            request.B = body
+            return body
     except Exception as e:
         logger.warning('Deserialize request body fail: %s' % str(e))
 
-
-def _get_parameter_str(args: OrderedDict):
-    return '\n\t\t'.join([str(args[arg]) for arg in args])
+    return {}
 
 
-def _get_value(data: dict, name: str, arg_spec: ArgumentSpecification, backup: dict = None):
+def _wrap_http_response(mgr, data):
     """
-
+    将数据包装成 HttpResponse 返回
     :param data:
-    :param name:
-    :param arg_spec:
-    :return: True 表示使用默认值 False 表示未使用默认值 None 表示无值
+    :return:
     """
-    if name in data:
-        return False, data[name]
-
-    alias = arg_spec.alias
-
-    if alias is not None and alias in data:
-        return False, data[alias]
-
-    if backup is not None:
-        if name in backup:
-            return False, backup[name]
-
-        if alias is not None and alias in backup:
-            return False, backup[alias]
-
-    # 使用默认值
-    if arg_spec.has_default:
-        return True, arg_spec.default
-
-    # 缺少无默认值的参数
-    return None, None
-
-
-def _get_actual_args(request: HttpRequest, func, args: OrderedDict) -> dict or HttpResponse:
-    method = request.method.lower()
-    actual_args = {}
-
-    # 已使用的参数名称，用于后期填充可变参数时作排除用
-    used_args = []
-    # 是否声明了可变参数
-    has_variable_args = False
-
-    # noinspection PyUnresolvedReferences
-    arg_source = request.G if method in ['delete', 'get'] else request.P
-
-    for arg_name in args.keys():
-        arg_spec = args.get(arg_name)
-
-        # 如果是可变参数：如: **kwargs
-        # 设置标记，以在后面进行填充
-        if arg_spec.is_variable:
-            has_variable_args = True
-            continue
-
-        # 以及情况将传入 HttpRequest 对象
-        # 1. 当参数名称是 request 并且未指定类型
-        # 2. 当参数类型是 HttpRequest 时 (不论参数名称，包括 request)
-        # 但是，参数名称是 request 但其类型不是 HttpRequest ，就会被当作一般参数处理
-        if arg_name == 'request' and not arg_spec.has_annotation:
-            actual_args[arg_name] = request
-            continue
-        if arg_spec.annotation == HttpRequest:
-            actual_args[arg_name] = request
-            continue
-
-        # noinspection PyUnresolvedReferences
-        use_default, arg_value = _get_value(arg_source, arg_name, arg_spec, request.B)
-
-        # 未找到参数
-        if use_default is None:
-            msg = '%s\n\tMissing required argument "%s":\n\t\t%s' % (
-                get_func_info(func),
-                arg_name,
-                _get_parameter_str(args)
-            )
-            logger.warning(msg)
-            return HttpResponseBadRequest(msg)
-
-        # 使用默认值
-        if use_default is True:
-            actual_args[arg_name] = arg_value
-            used_args.append(arg_name)
-            continue
-
-        # 未指定类型
-        if not arg_spec.has_annotation:
-            actual_args[arg_name] = arg_value
-            used_args.append(arg_name)
-            continue
-
-        # 当值为 None 时，不作数据类型校验
-        if arg_value is None:
-            actual_args[arg_name] = arg_value
-            used_args.append(arg_name)
-            continue
-
-        # 检查类型是否一致 #
-
-        # 类型一致，直接使用
-        if isinstance(arg_value, arg_spec.annotation):
-            actual_args[arg_name] = arg_value
-            used_args.append(arg_name)
-            continue
-
-        # 类型不一致，尝试转换类型
-
-        # 当声明的参数类型是布尔类型时，收到的值可能是一个字符串（其值为 true 、 false）
-        if arg_spec.annotation is bool and isinstance(arg_value, str):
-            if arg_value == 'true':
-                actual_args[arg_name] = True
-                used_args.append(arg_name)
-            elif arg_value == 'false':
-                actual_args[arg_name] = False
-                used_args.append(arg_name)
-            else:
-                logger.error('Value for "%s!%s" may be incorrect (a boolean value expected: true/false): %s' % (
-                    func.__name__, arg_name, arg_value))
-            continue
-
-        # 转换失败时，会抛出异常
-        # noinspection PyBroadException
-        try:
-            # 当 arg_value 是字符串，arg_spec的类型是对象时，尝试解析成 json
-            if arg_spec.annotation in (dict, list) and isinstance(arg_value, str):
-                # noinspection PyBroadException
-                try:
-                    arg_value = json.loads(arg_value)
-                except Exception:
-                    # 此处的异常直接忽略即可
-                    logger.warning('Value for "%s!%s" may be incorrect: %s' % (func.__name__, arg_name, arg_value))
-
-                # 类型一致，直接使用
-                if isinstance(arg_value, arg_spec.annotation):
-                    actual_args[arg_name] = arg_value
-                    used_args.append(arg_name)
-                    continue
-            actual_args[arg_name] = arg_spec.annotation(arg_value)
-            used_args.append(arg_name)
-        except Exception:
-            msg = 'Argument type of "%s" mismatch, expect type "%s" but got "%s", signature: (%s)' \
-                  % (arg_name, arg_spec.annotation.__name__, type(arg_value).__name__, _get_parameter_str(args))
-            logger.warning(msg)
-            return HttpResponseBadRequest(msg)
-
-    if not has_variable_args:
-        return actual_args
-
-    # 填充可变参数
-    variable_args = {}
-    for item in arg_source:
-        if item in used_args:
-            continue
-        variable_args[item] = arg_source[item]
-
-    # noinspection PyUnresolvedReferences
-    for item in request.B:
-        if item in used_args:
-            continue
-        # noinspection PyUnresolvedReferences
-        variable_args[item] = request.B[item]
-
-    actual_args.update(variable_args)
-
-    return actual_args
 
+    # 处理返回函数
+    return _to_http_response(mgr.process_return(data), mgr.meta.get('stream'), mgr.meta.get('chunk_size'))
 
-def _wrap_http_response(mgr, data):
+
+async def _wrap_http_response_async(mgr, data):
     """
-    将数据包装成 HttpResponse 返回
+    将数据包装成 HttpResponse 返回，中间件的 process_return 可以是异步的
     :param data:
     :return:
     """
 
     # 处理返回函数
-    data = mgr.process_return(data)
+    return _to_http_response(await mgr.process_return_async(data), mgr.meta.get('stream'),
+                             mgr.meta.get('chunk_size'))
+
 
+def _to_http_response(data, stream=None, chunk_size=None):
+    """
+    将数据转换成 HttpResponse
+    :param data:
+    :param stream: 流式响应的编码方式，指定时列表同样会使用流式响应
+    :param chunk_size: 读取 QuerySet 时，每次从数据库中获取的行数
+    :return:
+    """
     if data is None:
         return HttpResponse()
 
@@ -330,8 +383,18 @@ def _wrap_http_response(mgr, data):
     if isinstance(data, bool):
         return HttpResponse('true' if bool else 'false')
 
+    # QuerySet 使用数据库游标分批读取，并分批序列化发送
+    if isinstance(data, QuerySet):
+        chunk_size = queryset.QUERYSET_CHUNK_SIZE if chunk_size is None else chunk_size
+        return streaming.create_response(queryset.iterate(data, chunk_size), stream, chunk_size)
+
+    # 生成器与迭代器使用流式响应，逐项编码发送
+    if isinstance(data, Iterator) or hasattr(data, '__aiter__') or \
+            (stream is not None and isinstance(data, (list, tuple))):
+        return streaming.create_response(data, stream)
+
     if isinstance(data, (dict, list, set, tuple)):
-        return JsonResponse(data, safe=False)
+        return HttpResponse(codec.dumps(data), content_type='application/json')
 
     if isinstance(data, str):
         return HttpResponse(data.encode())
@@ -1,14 +1,19 @@
-from types import MethodType
+from types import MethodType, MappingProxyType
+
+from .util.utils import get_func_args
 
 
 class RouteMeta:
     """
     路由元数据
+    在路由处理函数被装饰时创建，创建后不可修改
     """
 
+    __slots__ = ('_handler', '_func_args', '_id', '_module', '_name', '_kwargs')
+
     def __init__(self,
                  handler: MethodType,
-                 func_args,
+                 func_args=None,
                  route_id=None,
                  module=None,
                  name=None,
@@ -16,18 +21,25 @@ class RouteMeta:
         """
 
         :param handler: 路由处理函数对象
-        :param func_args: 路由处理函数参数列表
+        :param func_args: 路由处理函数参数列表，为 None 时在首次访问时解析
         :param route_id: 路由ID，此ID由路由相关信息组合而成
         :param module: 装饰器上指定的 module 值
         :param name: 装饰器上指定的 name 值
         :param kwargs: 装饰器上指定的其它参数
         """
-        self._handler = handler
-        self._func_args = func_args
-        self._id = route_id
-        self._module = module
-        self._name = name
-        self._kwargs = {} if kwargs is None else kwargs
+        _set = object.__setattr__
+        _set(self, '_handler', handler)
+        _set(self, '_func_args', func_args)
+        _set(self, '_id', route_id)
+        _set(self, '_module', module)
+        _set(self, '_name', name)
+        _set(self, '_kwargs', MappingProxyType({} if kwargs is None else dict(kwargs)))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('RouteMeta is read-only')
+
+    def __delattr__(self, key):
+        raise AttributeError('RouteMeta is read-only')
 
     @property
     def handler(self) -> MethodType:
@@ -44,8 +56,20 @@ class RouteMeta:
         :return:
         :rtype: OrderedDict
         """
+        if self._func_args is None:
+            object.__setattr__(self, '_func_args', get_func_args(self._handler))
         return self._func_args
 
+    def init_func_args(self, func_args):
+        """
+        设置路由处理函数参数列表，用于加载持久化的参数列表，以避免反射
+        仅在参数列表尚未解析时有效
+        :param func_args:
+        :return:
+        """
+        if self._func_args is None:
+            object.__setattr__(self, '_func_args', func_args)
+
     @property
     def id(self) -> str:
         """
@@ -71,9 +95,9 @@ class RouteMeta:
         return self._name
 
     @property
-    def kwargs(self) -> dict:
+    def kwargs(self) -> MappingProxyType:
         """
-        装饰器上指定的其它参数
+        装饰器上指定的其它参数(只读)
         :return:
         :rtype: Dict
         """
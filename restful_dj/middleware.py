@@ -1,10 +1,24 @@
+import asyncio
+import inspect
+from functools import partial
+
 from django.http import HttpResponse, HttpRequest
 
 from .meta import RouteMeta
 
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:
+    # asgiref 随 Django 3.0 及以上版本安装，低版本的 Django 不支持异步的中间件
+    async_to_sync = None
+
 # 注册的路由中间件列表
 MIDDLEWARE_INSTANCE_LIST = []
 
+# 各路由需要调用的中间件函数，在路由首次调用时生成
+# 其键为 RouteMeta ，值依次为 process_request, process_invoke, process_return, process_response 阶段的函数
+_ROUTE_HOOKS = {}
+
 
 def register_middlewares(*middlewares):
     """
@@ -15,6 +29,75 @@ def register_middlewares(*middlewares):
     for middleware_cls in middlewares:
         MIDDLEWARE_INSTANCE_LIST.append(middleware_cls())
 
+    # 中间件列表已变化，需要重新生成各路由的中间件
+    _ROUTE_HOOKS.clear()
+
+
+def _applies_to(middleware, meta: RouteMeta) -> bool:
+    """
+    判断中间件是否作用于指定的路由
+    :param middleware:
+    :param meta:
+    :return:
+    """
+    applies_to = getattr(middleware, 'applies_to', None)
+    # 未实现或者使用的是基类中的实现，作用于所有路由
+    if applies_to is None or getattr(applies_to, '__func__', None) is MiddlewareBase.applies_to:
+        return True
+    return bool(applies_to(meta))
+
+
+def _get_hooks(middlewares: list, hook_name: str) -> tuple:
+    """
+    获取中间件中指定阶段的函数
+    :param middlewares: 中间件实例列表
+    :param hook_name: 函数名称
+    :return: 绑定到中间件实例的函数
+    """
+    base_hook = getattr(MiddlewareBase, hook_name)
+    hooks = []
+    for middleware in middlewares:
+        hook = getattr(middleware, hook_name, None)
+        # 未实现或者使用的是基类中的空实现，不需要调用
+        if hook is None or getattr(hook, '__func__', None) is base_hook:
+            continue
+        hooks.append(hook)
+    return tuple(hooks)
+
+
+def _get_route_hooks(meta: RouteMeta) -> tuple:
+    """
+    获取指定路由需要调用的中间件函数
+    :param meta:
+    :return:
+    """
+    hooks = _ROUTE_HOOKS.get(meta)
+    if hooks is not None:
+        return hooks
+
+    middlewares = [middleware for middleware in MIDDLEWARE_INSTANCE_LIST if _applies_to(middleware, meta)]
+    hooks = (
+        _get_hooks(middlewares, 'process_request'),
+        _get_hooks(middlewares, 'process_invoke'),
+        _get_hooks(middlewares, 'process_return'),
+        _get_hooks(middlewares, 'process_response'),
+    )
+    _ROUTE_HOOKS[meta] = hooks
+    return hooks
+
+
+def _wait(awaitable):
+    """
+    在同步的流程中等待异步中间件函数的返回值
+    :param awaitable:
+    :return:
+    """
+
+    async def wait():
+        return await awaitable
+
+    return async_to_sync(wait)()
+
 
 # noinspection PyMethodMayBeStatic,PyUnusedLocal
 class MiddlewareBase:
@@ -22,6 +105,15 @@ class MiddlewareBase:
     路由中间件基类
     """
 
+    def applies_to(self, meta: RouteMeta) -> bool:
+        """
+        判断此中间件是否作用于指定的路由。此函数对每个路由只会调用一次，其结果会被缓存，
+        因此只应该根据 meta 进行判断，不能依赖请求数据
+        :param meta:
+        :return: 返回 False 时，此路由的请求不会调用此中间件
+        """
+        return True
+
     def process_request(self, request: HttpRequest, meta: RouteMeta, **kwargs):
         """
         对 request 对象进行预处理。一般用于请求的数据的解码，此时路由组件尚水进行请求数据的解析(B,P,G 尚不可用)
@@ -47,6 +139,7 @@ class MiddlewareBase:
         :param request:
         :param meta:
         :param kwargs: 始终会有一个 'data' 的项，表示路由返回的原始数据
+            当其为迭代器时(流式响应)，不应该读取其全部内容，可以返回一个包装它的新生成器
         :return: 返回 HttpResponse 以终止执行，否则返回新的 数据
         """
         assert 'data' in kwargs
@@ -70,17 +163,30 @@ class MiddlewareManager:
     路由中间件管理器
     """
 
-    def __init__(self, request: HttpRequest, meta: RouteMeta):
+    def __init__(self, request: HttpRequest, meta: RouteMeta, run_sync=None):
         # HTTP请求对象
         self.request = request
         # 元数据信息
         self.meta = meta
+        # 在异步流程中执行同步中间件函数的方式(如在线程池中执行)，为 None 时直接调用
+        self._run_sync = run_sync
+        # 此路由需要调用的中间件函数
+        self._request_hooks, self._invoke_hooks, self._return_hooks, self._response_hooks = _get_route_hooks(meta)
+
+    @staticmethod
+    def prepare(meta: RouteMeta):
+        """
+        预先生成指定路由需要调用的中间件函数
+        :param meta:
+        :return:
+        """
+        _get_route_hooks(meta)
 
     def begin(self):
-        for middleware in MIDDLEWARE_INSTANCE_LIST:
-            if not hasattr(middleware, 'process_request'):
-                continue
-            result = middleware.process_request(self.request, self.meta)
+        for process_request in self._request_hooks:
+            result = process_request(self.request, self.meta)
+            if inspect.isawaitable(result):
+                result = _wait(result)
             if isinstance(result, HttpResponse):
                 return result
             # 返回 False 以阻止后续中间件执行
@@ -92,10 +198,10 @@ class MiddlewareManager:
         在路由函数调用前，对其参数等进行处理
         :return:
         """
-        for middleware in MIDDLEWARE_INSTANCE_LIST:
-            if not hasattr(middleware, 'process_invoke'):
-                continue
-            result = middleware.process_invoke(self.request, self.meta)
+        for process_invoke in self._invoke_hooks:
+            result = process_invoke(self.request, self.meta)
+            if inspect.isawaitable(result):
+                result = _wait(result)
             if isinstance(result, HttpResponse):
                 return result
             # 返回 False 以阻止后续中间件执行
@@ -108,10 +214,10 @@ class MiddlewareManager:
         :param data:
         :return:
         """
-        for middleware in MIDDLEWARE_INSTANCE_LIST:
-            if not hasattr(middleware, 'process_return'):
-                continue
-            result = middleware.process_return(self.request, self.meta, data=data)
+        for process_return in self._return_hooks:
+            result = process_return(self.request, self.meta, data=data)
+            if inspect.isawaitable(result):
+                result = _wait(result)
 
             # 返回 HttpResponse 终止
             if result is HttpResponse:
@@ -129,9 +235,80 @@ class MiddlewareManager:
         :return:
         """
         # 对 response 进行处理
-        for middleware in MIDDLEWARE_INSTANCE_LIST:
-            if not hasattr(middleware, 'process_response'):
-                continue
-            response = middleware.process_response(self.request, self.meta, response=response)
+        for process_response in self._response_hooks:
+            response = process_response(self.request, self.meta, response=response)
+            if inspect.isawaitable(response):
+                response = _wait(response)
+
+        return response
+
+    async def _call_async(self, hook, **kwargs):
+        """
+        在异步流程中调用中间件函数，同步的函数会通过 run_sync 执行
+        :param hook:
+        :param kwargs:
+        :return:
+        """
+        if self._run_sync is None or asyncio.iscoroutinefunction(hook):
+            result = hook(self.request, self.meta, **kwargs)
+        else:
+            result = await self._run_sync(partial(hook, self.request, self.meta, **kwargs))
+
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def begin_async(self):
+        """
+        begin 的异步版本，中间件函数可以是异步的
+        :return:
+        """
+        for process_request in self._request_hooks:
+            result = await self._call_async(process_request)
+            if isinstance(result, HttpResponse):
+                return result
+            # 返回 False 以阻止后续中间件执行
+            if result is False:
+                return
+
+    async def before_invoke_async(self):
+        """
+        before_invoke 的异步版本，中间件函数可以是异步的
+        :return:
+        """
+        for process_invoke in self._invoke_hooks:
+            result = await self._call_async(process_invoke)
+            if isinstance(result, HttpResponse):
+                return result
+            # 返回 False 以阻止后续中间件执行
+            if result is False:
+                return
+
+    async def process_return_async(self, data):
+        """
+        process_return 的异步版本，中间件函数可以是异步的
+        :param data:
+        :return:
+        """
+        for process_return in self._return_hooks:
+            result = await self._call_async(process_return, data=data)
+
+            # 返回 HttpResponse 终止
+            if result is HttpResponse:
+                return result
+
+            # 使用原数据
+            data = result
+
+        return data
+
+    async def end_async(self, response):
+        """
+        end 的异步版本，中间件函数可以是异步的
+        :param response:
+        :return:
+        """
+        for process_response in self._response_hooks:
+            response = await self._call_async(process_response, response=response)
 
         return response
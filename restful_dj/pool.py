@@ -0,0 +1,177 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from django.db import close_old_connections
+
+try:
+    import contextvars
+except ImportError:
+    # Python 3.7 以下版本没有 contextvars
+    contextvars = None
+
+# 默认线程池的名称，未在路由上指定线程池时使用
+DEFAULT_POOL = 'default'
+
+# 批量请求(batch)的子调用使用的线程池名称
+BATCH_POOL = 'batch'
+
+# 未注册时会自动创建的线程池
+_AUTO_POOLS = (DEFAULT_POOL, BATCH_POOL)
+
+# 已注册的线程池
+POOLS = {}
+
+_POOLS_LOCK = Lock()
+
+
+class PoolFullError(Exception):
+    """
+    线程池的等待队列已满
+    """
+    pass
+
+
+class RoutePool:
+    """
+    用于在异步分发(ASGI)中执行同步的路由处理函数与中间件函数的线程池
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int = 0):
+        """
+
+        :param name: 线程池名称
+        :param max_workers: 最大线程数量
+        :param max_queue: 最大等待数量，超出时拒绝执行(抛出 PoolFullError)，为 0 时不限制
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='restful-dj-%s' % name)
+        self._lock = Lock()
+        # 等待执行的数量
+        self._pending = 0
+        # 正在执行的数量
+        self._running = 0
+        # 已完成的数量
+        self._completed = 0
+        # 因等待队列已满而被拒绝的数量
+        self._rejected = 0
+
+    async def run(self, func, *args):
+        """
+        在线程池中执行同步函数，并等待其返回值
+        :param func:
+        :param args:
+        :return:
+        """
+        self._acquire()
+        context = None if contextvars is None else contextvars.copy_context()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._call, context, func, args)
+
+    def submit(self, func, *args):
+        """
+        在线程池中执行同步函数，不等待其返回值
+        :param func:
+        :param args:
+        :return: concurrent.futures.Future
+        """
+        self._acquire()
+        context = None if contextvars is None else contextvars.copy_context()
+        return self._executor.submit(self._call, context, func, args)
+
+    def _acquire(self):
+        with self._lock:
+            if self.max_queue and self._pending >= self.max_queue:
+                self._rejected += 1
+                raise PoolFullError('[restful-dj] Pool "%s" is full' % self.name)
+            self._pending += 1
+
+    def _call(self, context, func, args):
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+        # 线程池中的线程不会触发 request_started/request_finished 信号，
+        # 需要自行释放过期或不可用的数据库连接，否则每个线程会一直持有一个连接
+        close_old_connections()
+        try:
+            if context is None:
+                return func(*args)
+            return context.run(func, *args)
+        finally:
+            close_old_connections()
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def info(self) -> dict:
+        """
+        获取线程池的统计信息
+        :return:
+        """
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self._pending,
+            'running': self._running,
+            'completed': self._completed,
+            'rejected': self._rejected
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def register_pool(name: str, max_workers: int, max_queue: int = 0):
+    """
+    注册线程池，路由可以通过 @route(..., pool='name') 指定其同步函数执行的线程池
+    :param name: 线程池名称，为 default 时替换默认线程池
+    :param max_workers: 最大线程数量
+    :param max_queue: 最大等待数量，超出时拒绝执行(返回 503)，为 0 时不限制
+    :return:
+    """
+    with _POOLS_LOCK:
+        old_pool = POOLS.get(name)
+        POOLS[name] = RoutePool(name, max_workers, max_queue)
+
+    if old_pool is not None:
+        old_pool.shutdown(wait=False)
+
+
+def check_pool(name: str):
+    """
+    检查线程池是否已注册，在注册路由时调用，以便于在启动时发现错误的线程池名称
+    :param name: 为 None 时不检查
+    :return:
+    """
+    if name is not None and name not in POOLS and name not in _AUTO_POOLS:
+        raise Exception('[restful-dj] Pool "%s" not registered, did you forgot to call `restful_dj.register_pool`' % name)
+
+
+def get_pool(name: str = DEFAULT_POOL) -> RoutePool:
+    """
+    获取线程池，默认线程池与批量请求的线程池未注册时，会自动创建
+    :param name:
+    :return:
+    """
+    pool = POOLS.get(name)
+    if pool is not None:
+        return pool
+
+    check_pool(name)
+
+    with _POOLS_LOCK:
+        pool = POOLS.get(name)
+        if pool is None:
+            pool = POOLS[name] = RoutePool(name, min(32, (os.cpu_count() or 1) + 4))
+    return pool
+
+
+def pool_info() -> dict:
+    """
+    获取所有线程池的统计信息
+    :return: {线程池名称: 统计信息}
+    """
+    return {name: pool.info() for name, pool in POOLS.items()}
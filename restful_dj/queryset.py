@@ -0,0 +1,82 @@
+from django.db.models.query import ModelIterable, QuerySet
+from django.http import HttpRequest, HttpResponseBadRequest
+
+from .meta import RouteMeta
+from .util import converter
+
+# 读取 QuerySet 时，每次从数据库中获取的行数(同时也是每次序列化的行数)
+QUERYSET_CHUNK_SIZE = 2000
+
+# 分页参数的默认配置，可以通过 @route(paging={...}) 修改
+# limit: 未传入 limit 参数时，默认返回的行数
+# max_limit: limit 参数的最大值
+DEFAULT_PAGING = {
+    'limit': 100,
+    'max_limit': 1000
+}
+
+# 从 queryString 中读取分页参数的请求方法，其它方法从 POST 中读取
+_QUERY_METHODS = ('delete', 'get')
+
+_convert_int = converter.compile_converter(int)
+
+
+def iterate(queryset: QuerySet, chunk_size: int = None):
+    """
+    使用数据库游标分批读取 QuerySet ，不会将所有行加载到内存中
+    返回模型对象的 QuerySet 会转换成 values() ，直接读取字段的值
+    :param queryset:
+    :param chunk_size: 每次从数据库中获取的行数
+    :return:
+    """
+    # noinspection PyProtectedMember
+    if queryset._iterable_class is ModelIterable:
+        queryset = queryset.values()
+    return queryset.iterator(chunk_size=chunk_size or QUERYSET_CHUNK_SIZE)
+
+
+def _get_paging_arg(request: HttpRequest, arg_name: str, default_value: int):
+    # noinspection PyUnresolvedReferences
+    arg_source = request.G if request.method.lower() in _QUERY_METHODS else request.P
+    if arg_name in arg_source:
+        arg_value = arg_source[arg_name]
+    else:
+        # noinspection PyUnresolvedReferences
+        arg_value = request.B.get(arg_name, default_value) if isinstance(request.B, dict) else default_value
+
+    if arg_value is None:
+        return default_value
+
+    arg_value = _convert_int(arg_value)
+    if arg_value is converter.INVALID or arg_value < 0:
+        return None
+    return arg_value
+
+
+def apply_paging(request: HttpRequest, meta: RouteMeta, queryset: QuerySet):
+    """
+    使用请求中的 offset 与 limit 参数对 QuerySet 进行分页(仅对指定了 @route(paging=...) 的路由)
+    :param request:
+    :param meta:
+    :param queryset:
+    :return: 分页参数不合法时返回 HttpResponseBadRequest
+    """
+    paging = meta.get('paging')
+    if not paging:
+        return queryset
+
+    options = DEFAULT_PAGING if not isinstance(paging, dict) else dict(DEFAULT_PAGING, **paging)
+
+    offset = _get_paging_arg(request, 'offset', 0)
+    if offset is None:
+        return HttpResponseBadRequest('Invalid paging argument "offset", a non-negative integer expected')
+
+    limit = _get_paging_arg(request, 'limit', options['limit'])
+    if limit is None:
+        return HttpResponseBadRequest('Invalid paging argument "limit", a non-negative integer expected')
+
+    max_limit = options['max_limit']
+    if max_limit and limit > max_limit:
+        limit = max_limit
+
+    return queryset[offset:offset + limit]
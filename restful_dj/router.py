@@ -1,11 +1,19 @@
-import inspect
+import gc
 import os
-from types import MethodType
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Lock
 
 from django import shortcuts
 from django.conf import settings
-from django.http import HttpResponseNotFound, HttpResponseServerError, HttpRequest, HttpResponse
+from django.http import HttpResponseNotFound, HttpResponseNotAllowed, HttpResponseServerError, HttpRequest, \
+    HttpResponse
 
+from .meta import RouteMeta
+from .pool import PoolFullError, check_pool
 from .util import logger
 from .util import utils
 from .util.utils import load_module
@@ -14,17 +22,59 @@ from .util.utils import load_module
 NAME = 'restful_dj'
 
 # 函数缓存，减少 inspect 反射调用次数
+# 其键为 (模块名称, 函数名称)
 ENTRY_CACHE = {}
 
+# 不存在的函数的缓存，其键为 (模块名称, 函数名称)
+# 按最近使用顺序淘汰，避免大量随机路径的请求导致其无限增长
+_MISSING_ENTRY_CACHE = OrderedDict()
+# 不存在的函数的缓存的最大数量
+MISSING_ENTRY_CACHE_SIZE = 1024
+_MISSING_ENTRY_LOCK = Lock()
+
+# 路由模块的路径解析缓存，用于减少检查文件是否存在的系统调用
+# 其键为映射后的模块名称，值为 (解析后的模块名称，模块不存在时为 None, 所在目录, 所在目录的修改时间, 下次校验的时间)
+_MODULE_PATH_CACHE = {}
+# 路由模块的路径解析缓存的最大数量，超出时清空
+MODULE_PATH_CACHE_SIZE = 4096
+# 路由模块的路径解析缓存的校验间隔(秒)，在此间隔内直接使用缓存，超过后通过所在目录的修改时间判断是否需要重新解析
+MODULE_PATH_CHECK_INTERVAL = 2
+
+# 函数缓存的命中统计
+_ENTRY_CACHE_STATS = {
+    'hits': 0,
+    'missing_hits': 0,
+    'misses': 0
+}
+
 _BEFORE_DISPATCH_HANDLER = None
 
 # 线上模式时，使用固定路由
+# 其键为 (entry, name)，值为 {method: 路由}
 PRODUCTION_ROUTES = {}
 
 # 路由映射表，其键为请求的路径，其值为映射的目录
 ROUTES_MAP = {}
 
 
+class _RouteMapNode:
+    """
+    路由映射前缀树的节点，每个节点对应请求路径中以 . 分隔的一段
+    """
+
+    __slots__ = ('children', 'target')
+
+    def __init__(self):
+        # 子节点: {路径段: _RouteMapNode}
+        self.children = {}
+        # 映射的目录，未映射时为 None
+        self.target = None
+
+
+# 路由映射前缀树，由 ROUTES_MAP 生成
+_ROUTES_TRIE = _RouteMapNode()
+
+
 def map_routes(routes_map: dict):
     """
     注册路由映射表
@@ -34,36 +84,315 @@ def map_routes(routes_map: dict):
     for path in routes_map:
         ROUTES_MAP[path] = routes_map[path]
 
+        node = _ROUTES_TRIE
+        for segment in _split_route_path(path):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _RouteMapNode()
+            node = child
+        node.target = routes_map[path]
+
+    # 映射表已变化，清除已缓存的查找结果
+    _resolve_route_map.cache_clear()
+
+
+def _split_route_path(route_path: str) -> list:
+    route_path = route_path.strip('.')
+    return route_path.split('.') if route_path else []
+
+
+@lru_cache(maxsize=1024)
+def _resolve_route_map(route_path: str):
+    """
+    在路由映射前缀树中查找与请求路径匹配的最长前缀，并将其替换为映射的目录
+    :param route_path:
+    :return: 未找到映射时返回 None
+    """
+    segments = _split_route_path(route_path)
+
+    node = _ROUTES_TRIE
+    # 命中的映射目录，以及其在路径中所占的段数
+    hit_target = node.target
+    hit_depth = 0
+    for depth, segment in enumerate(segments, 1):
+        node = node.children.get(segment)
+        if node is None:
+            break
+        if node.target is not None:
+            hit_target = node.target
+            hit_depth = depth
+
+    if hit_target is None:
+        return None
+
+    # 将请求路径替换为指定的映射路径
+    return '.'.join([hit_target] + segments[hit_depth:]).strip('.')
+
 
 def register_routes(routes: list):
     """
     手动注册路由列表
-    :param routes: 其每一项都应该是一个 list, 元素依次为 method: str, path: str, handler: MethodType
+    :param routes: 其每一项都应该是一个 list, 元素依次为 method: str, path: str, handler: MethodType or str,
+        args: list (可选，由 persist 生成的参数列表)
+        handler 为 str 时(格式为 module:name)，会在首次请求时才导入其所在模块
     :return:
     """
     for _route in routes:
         register(*_route)
 
 
-def register(method: str, path: str, handler: MethodType):
+def register(method: str, path: str, handler, args: list = None):
     """
     手动注册路由
     :param path:
     :param method:
-    :param handler:
+    :param handler: 路由处理函数，或者其引用路径(格式为 module:name)，此时会在首次请求时才导入其所在模块
+    :param args: 由 persist 生成的参数列表，指定时不再通过反射获取参数列表
     :return:
     """
-    rid = '%s#%s' % (path, method.lower())
-    if rid in PRODUCTION_ROUTES:
+    # 线上路由表为两级结构: (entry, name) -> {method -> 路由}
+    # 以便于分发时不需要再拼接字符串
+    entry, _, name = path.partition('/')
+    method = method.upper()
+
+    methods = PRODUCTION_ROUTES.setdefault((entry, name), {})
+    if method in methods:
         logger.warning('[restful-dj] %s %s exists' % (method, path))
 
-    args = utils.get_func_args(handler)
-    PRODUCTION_ROUTES[rid] = {
+    # 延迟加载的路由
+    if isinstance(handler, str):
+        methods[method] = {
+            'func': None,
+            'args': None,
+            'ref': handler,
+            'define': args,
+            'lock': Lock()
+        }
+        return
+
+    methods[method] = {
         'func': handler,
-        'args': args
+        'args': _init_handler_args(handler, args)
     }
 
 
+def _init_handler_args(handler, args: list = None):
+    meta = handler.route_meta
+    # 线程池需要在注册路由之前注册
+    check_pool(meta.get('pool'))
+    if args is not None:
+        try:
+            meta.init_func_args(utils.load_func_args(args, meta.handler))
+        except (ImportError, AttributeError) as e:
+            # 参数的类型已被移动或删除(路由映射文件已过期)，通过反射获取
+            logger.warning('[restful-dj] Load persisted arguments of "%s" failed, resolve them by reflection: %s' % (
+                meta.id, repr(e)))
+    return meta.func_args
+
+
+def _load_route(route: dict):
+    """
+    加载延迟加载的路由，同一个路由只会被加载一次
+    :param route:
+    :return: 路由处理函数
+    """
+    with route['lock']:
+        func = route['func']
+        if func is not None:
+            return func
+
+        module_name, _, func_name = route['ref'].partition(':')
+        func = getattr(load_module(module_name), func_name)
+        route['args'] = _init_handler_args(func, route['define'])
+        route['func'] = func
+        return func
+
+
+def warmup_routes(paths: list = None, workers: int = 4):
+    """
+    预先加载延迟加载的路由，一般在启动时对常用的路由调用
+    :param paths: 需要加载的路由路径(格式为 entry 或 entry/name)，不指定时加载所有路由
+    :param workers: 并行加载的线程数量
+    :return:
+    """
+    routes = []
+    if paths is None:
+        for methods in PRODUCTION_ROUTES.values():
+            routes.extend(methods.values())
+    else:
+        for path in paths:
+            entry, _, name = path.partition('/')
+            methods = PRODUCTION_ROUTES.get((entry, name))
+            if methods is None:
+                logger.warning('[restful-dj] Route "%s" not found' % path)
+                continue
+            routes.extend(methods.values())
+
+    routes = [route for route in routes if route['func'] is None]
+    if not routes:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(_load_route, route) for route in routes]:
+            e = future.exception()
+            if e is not None:
+                logger.error('[restful-dj] Load route failed', e, _raise=False)
+
+
+def preload(workers: int = 4) -> dict:
+    """
+    在主进程中预先加载所有已注册的路由，用于 gunicorn --preload 等在加载后 fork 工作进程的场景
+    会导入所有路由模块，生成参数列表、参数绑定器与中间件，然后调用 gc.freeze() ，
+    使这些对象在工作进程中保持共享(写时复制)，而不是在每个工作进程中各自生成
+    应该在 register_routes 与 register_middlewares 之后调用
+    :param workers: 并行导入路由模块的线程数量
+    :return: routes: 加载的路由数量, rss_before: 加载前的内存占用(字节), rss_after: 加载后的内存占用(字节)
+    """
+    rss_before = _get_rss()
+
+    warmup_routes(workers=workers)
+
+    count = 0
+    for methods in PRODUCTION_ROUTES.values():
+        for route in methods.values():
+            func = route['func']
+            # 加载失败的路由
+            if func is None:
+                continue
+            func.route_prepare()
+            count += 1
+
+    gc.collect()
+    # gc.freeze 在 Python 3.7 及以上版本才可用
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    rss_after = _get_rss()
+
+    if rss_before is None or rss_after is None:
+        logger.info('[restful-dj] Preloaded %d routes' % count)
+    else:
+        logger.info('[restful-dj] Preloaded %d routes, memory: %.1fMB -> %.1fMB' % (
+            count, rss_before / 1048576, rss_after / 1048576))
+
+    return {
+        'routes': count,
+        'rss_before': rss_before,
+        'rss_after': rss_after
+    }
+
+
+def _get_rss():
+    """
+    获取当前进程的内存占用(Resident Set Size)
+    :return: 字节数，无法获取时返回 None
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # 无法获取当前值时，使用峰值
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 下单位为字节，其它系统为 KB
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def entry_cache_info() -> dict:
+    """
+    获取函数缓存的统计信息
+    :return: hits: 命中已存在函数的次数, missing_hits: 命中不存在函数的次数, misses: 未命中缓存的次数,
+        size: 已存在函数的缓存数量, missing_size: 不存在函数的缓存数量
+    """
+    info = dict(_ENTRY_CACHE_STATS)
+    info['size'] = len(ENTRY_CACHE)
+    info['missing_size'] = len(_MISSING_ENTRY_CACHE)
+    return info
+
+
+def clear_module_path_cache():
+    """
+    清除路由模块的路径解析缓存，可以在路由文件变化时(如文件监视器中)调用
+    :return:
+    """
+    _MODULE_PATH_CACHE.clear()
+
+
+def _get_mtime(dir_name: str):
+    try:
+        return os.stat(dir_name).st_mtime
+    except OSError:
+        return None
+
+
+def _resolve_module_path(module_name: str):
+    """
+    根据文件系统判断模块是包还是模块
+    :param module_name: 映射后的模块名称
+    :return: 包时返回其 __init__ 模块名称，模块不存在时返回 None
+    """
+    now = time.monotonic()
+    cached = _MODULE_PATH_CACHE.get(module_name)
+    if cached is not None:
+        resolved, dir_name, mtime, expires = cached
+        if now < expires:
+            return resolved
+        # 所在目录未发生变化时(没有文件或目录被创建、删除、重命名)，继续使用缓存
+        if _get_mtime(dir_name) == mtime:
+            _MODULE_PATH_CACHE[module_name] = (resolved, dir_name, mtime, now + MODULE_PATH_CHECK_INTERVAL)
+            return resolved
+
+    abs_path = os.path.join(settings.BASE_DIR, module_name.replace('.', os.path.sep))
+    dir_name = os.path.dirname(abs_path)
+    mtime = _get_mtime(dir_name)
+
+    # 如果 module_name 是目录，那么就查找 __init__.py 是否存在
+    if os.path.isdir(abs_path):
+        logger.info('Entry "%s" is package, auto load module "__init__.py"' % module_name)
+        resolved = '%s.%s' % (module_name, '__init__')
+    elif os.path.exists('%s.py' % abs_path):
+        resolved = module_name
+    else:
+        resolved = None
+
+    if len(_MODULE_PATH_CACHE) >= MODULE_PATH_CACHE_SIZE:
+        _MODULE_PATH_CACHE.clear()
+    _MODULE_PATH_CACHE[module_name] = (resolved, dir_name, mtime, now + MODULE_PATH_CHECK_INTERVAL)
+    return resolved
+
+
+def _cache_missing_entry(key: tuple):
+    """
+    缓存不存在的函数
+    :param key: (模块名称, 函数名称)
+    :return:
+    """
+    with _MISSING_ENTRY_LOCK:
+        _MISSING_ENTRY_CACHE[key] = True
+        while len(_MISSING_ENTRY_CACHE) > MISSING_ENTRY_CACHE_SIZE:
+            _MISSING_ENTRY_CACHE.popitem(last=False)
+
+
+def _is_missing_entry(key: tuple) -> bool:
+    """
+    判断函数是否已被缓存为不存在
+    :param key: (模块名称, 函数名称)
+    :return:
+    """
+    if key not in _MISSING_ENTRY_CACHE:
+        return False
+    with _MISSING_ENTRY_LOCK:
+        if key not in _MISSING_ENTRY_CACHE:
+            return False
+        _MISSING_ENTRY_CACHE.move_to_end(key)
+    return True
+
+
 def set_before_dispatch_handler(handler):
     """
     设置请求分发前的处理函数
@@ -99,36 +428,149 @@ def dispatch(request, entry, name=''):
         entry, name = _BEFORE_DISPATCH_HANDLER(request, entry, name)
 
     if not settings.DEBUG:
-        return _route_for_production(request, entry, name)
+        func = _get_production_handler(request, entry, name)
+    else:
+        func = _get_debug_handler(request, entry, name)
+
+    if isinstance(func, HttpResponse):
+        return func
+
+    return _invoke_handler(request, func)
+
+
+async def dispatch_async(request, entry, name=''):
+    """
+    异步的 REST-ful 路由分发入口，用于 ASGI
+    异步的路由处理函数(async def)会在事件循环中执行，同步的路由处理函数会在线程中执行
+    :param request: 请求
+    :param entry: 入口文件，包名使用 . 符号分隔
+    :param name='' 指定的函数名称
+    :return:
+    """
+    if _BEFORE_DISPATCH_HANDLER is not None:
+        # noinspection PyCallingNonCallable
+        entry, name = _BEFORE_DISPATCH_HANDLER(request, entry, name)
+
+    if not settings.DEBUG:
+        func = _get_production_handler(request, entry, name)
+    else:
+        func = _get_debug_handler(request, entry, name)
+
+    if isinstance(func, HttpResponse):
+        return func
+
+    return await _invoke_handler_async(request, func)
+
+
+def _partition_route_path(route_path: str):
+    """
+    从请求路径中拆分出 entry 与 name
+    :param route_path: 请求路径，格式为 entry 或 entry/name ，可以以 / 结尾
+    :return: 格式不正确时返回 None
+    """
+    if route_path[-1] == '/':
+        route_path = route_path[:-1]
+
+    entry, sep, name = route_path.partition('/')
+
+    # 与 entry/name 格式不匹配的地址
+    if not entry or (sep and not name) or '/' in name:
+        return None
+
+    return entry, name
+
+
+def dispatch_path(request, route_path):
+    """
+    单一入口的路由分发，自行从路径中拆分出 entry 与 name
+    以 / 结尾的地址会被直接处理，而不是重定向
+    :param request: 请求
+    :param route_path: 请求路径，格式为 entry 或 entry/name ，可以以 / 结尾
+    :return:
+    """
+    route = _partition_route_path(route_path)
+    if route is None:
+        return HttpResponseNotFound()
+
+    return dispatch(request, *route)
+
+
+async def dispatch_path_async(request, route_path):
+    """
+    dispatch_path 的异步版本，用于 ASGI
+    :param request: 请求
+    :param route_path: 请求路径，格式为 entry 或 entry/name ，可以以 / 结尾
+    :return:
+    """
+    route = _partition_route_path(route_path)
+    if route is None:
+        return HttpResponseNotFound()
 
+    return await dispatch_async(request, *route)
+
+
+def _get_debug_handler(request, entry, name):
+    """
+    开发模式时，根据请求查找路由处理函数
+    :return: 未找到时返回 HttpResponse
+    """
     router = Router(request, request.method, entry, name)
     check_result = router.check()
     if isinstance(check_result, HttpResponse):
         return check_result
-    return router.route()
+    return router.get_handler()
 
 
-def _route_for_production(request, entry, name):
-    method = request.method.lower()
-    # noinspection PyBroadException
-    try:
-        if name == '':
-            route = PRODUCTION_ROUTES['%s#%s' % (entry, method)]
-        else:
-            route = PRODUCTION_ROUTES['%s/%s#%s' % (entry, name, method)]
-    except Exception:
+def _get_production_handler(request, entry, name):
+    """
+    线上模式时，根据请求查找路由处理函数
+    :return: 未找到时返回 HttpResponse
+    """
+    methods = PRODUCTION_ROUTES.get((entry, name))
+    if methods is None:
         return HttpResponseNotFound()
 
-    return _invoke_handler(request, route['func'], route['args'])
+    route = methods.get(request.method)
+    if route is None:
+        # 路径存在，但不支持此请求方法
+        return HttpResponseNotAllowed(list(methods))
+
+    func = route['func']
+    if func is None:
+        try:
+            func = _load_route(route)
+        except Exception as e:
+            message = '[restful-dj]\n\tLoad route "%s" failed' % route['ref']
+            logger.error(message, e)
+            return HttpResponseServerError('%s: %s' % (message, str(e)))
+
+    return func
+
+
+def _invoke_handler(request, func):
+    try:
+        return func.route_invoke(request, func)
+    except PoolFullError as e:
+        logger.warning(str(e))
+        return HttpResponse(status=503)
+    except Exception as e:
+        return _handle_invoke_error(func, e)
 
 
-def _invoke_handler(request, func, args):
+async def _invoke_handler_async(request, func):
     try:
-        return func(request, args)
+        return await func.route_invoke_async(request, func)
+    except PoolFullError as e:
+        logger.warning(str(e))
+        return HttpResponse(status=503)
     except Exception as e:
-        message = '[restful-dj]\n\t%s' % utils.get_func_info(func)
-        logger.error(message, e)
-        return HttpResponseServerError('%s: %s' % (message, str(e)))
+        return _handle_invoke_error(func, e)
+
+
+def _handle_invoke_error(func, e):
+    message = '[restful-dj]\n\t%s' % utils.get_func_info(func)
+    logger.error(message, e)
+    return HttpResponseServerError('%s: %s' % (message, str(e)))
 
 
 class Router:
@@ -160,12 +602,8 @@ class Router:
             logger.warning('Cannot find route map in RESTFUL_DJ.routes: %s' % self.entry)
             return HttpResponseNotFound()
 
-        # 如果 module_name 是目录，那么就查找 __init__.py 是否存在
-        abs_path = os.path.join(settings.BASE_DIR, module_name.replace('.', os.path.sep))
-        if os.path.isdir(abs_path):
-            logger.info('Entry "%s" is package, auto load module "__init__.py"' % module_name)
-            module_name = '%s.%s' % (module_name, '__init__')
-        elif not os.path.exists('%s.py' % abs_path):
+        module_name = _resolve_module_path(module_name)
+        if module_name is None:
             return HttpResponseNotFound()
 
         self.module_name = module_name
@@ -174,6 +612,16 @@ class Router:
         self.fullname = '%s.%s' % (module_name, self.func_name)
 
     def route(self):
+        func = self.get_handler()
+        if isinstance(func, HttpResponse):
+            return func
+        return _invoke_handler(self.request, func)
+
+    def get_handler(self):
+        """
+        获取路由处理函数
+        :return: 未找到时返回 HttpResponse
+        """
         try:
             func_define = self.get_func_define()
         except Exception as e:
@@ -183,23 +631,31 @@ class Router:
 
         # 如果 func_define 为 False ，那就表示此函数不存在
         if func_define is False:
-            message = 'Route "%s.%s" not found' % (self.module_name, self.func_name)
-            logger.info(message)
             return HttpResponseNotFound()
 
-        if func_define is HttpResponse:
+        if isinstance(func_define, HttpResponse):
             return func_define
 
-        return _invoke_handler(self.request, func_define['func'], func_define['args'])
+        return func_define['func']
 
     def get_func_define(self):
         fullname = self.fullname
         func_name = self.func_name
         module_name = self.module_name
+        cache_key = (module_name, func_name)
 
         # 缓存中有这个函数
-        if fullname in ENTRY_CACHE.keys():
-            return ENTRY_CACHE[fullname]
+        func_define = ENTRY_CACHE.get(cache_key)
+        if func_define is not None:
+            _ENTRY_CACHE_STATS['hits'] += 1
+            return func_define
+
+        # 已经确定此函数不存在
+        if _is_missing_entry(cache_key):
+            _ENTRY_CACHE_STATS['missing_hits'] += 1
+            return False
+
+        _ENTRY_CACHE_STATS['misses'] += 1
 
         # 缓存中没有这个函数，去模块中查找
         # ---------------
@@ -216,8 +672,9 @@ class Router:
 
         # 模块中也没有这个函数
         if not hasattr(entry_define, func_name):
+            logger.info('Route "%s" not found' % fullname)
             # 函数不存在，更新缓存
-            ENTRY_CACHE[func_name] = False
+            _cache_missing_entry(cache_key)
             return False
 
         # 模块中有这个函数
@@ -230,46 +687,26 @@ class Router:
             )
             logger.warning(msg)
             # 没有配置装饰器@route，则认为函数不可访问，更新缓存
-            ENTRY_CACHE[func_name] = False
+            _cache_missing_entry(cache_key)
             return False
 
-        ENTRY_CACHE[fullname] = {
+        ENTRY_CACHE[cache_key] = {
             'func': func,
             # 该函数的参数列表
             # 'name': {
             #     'annotation': '类型', 当未指定类型时，无此项
             #     'default': '默认值'，当未指定默认值时，无此项
             # }
-            'args': utils.get_func_args(func)
+            'args': func.route_meta.func_args
         }
 
-        return ENTRY_CACHE[fullname]
+        return ENTRY_CACHE[cache_key]
 
     @staticmethod
     def is_valid_route(func):
-        source = inspect.getsource(func)
-        lines = source.split('\n')
-        for line in lines:
-            if line.startswith('def '):
-                # 已经查找到了函数定义部分了，说明没有找到
-                return False
-
-            if line.startswith('@route('):
-                # 是 @route 装饰器行
-                return True
-        return False
+        # 使用 @route 装饰的函数上会有路由元数据
+        return isinstance(getattr(func, 'route_meta', None), RouteMeta)
 
     @staticmethod
     def get_route_map(route_path):
-        # 命中
-        hit_route = None
-        for root_path in ROUTES_MAP:
-            if route_path.startswith(root_path):
-                hit_route = root_path, ROUTES_MAP[root_path]
-                break
-
-        if hit_route is None:
-            return None
-
-        # 将请求路径替换为指定的映射路径
-        return ('%s%s' % (hit_route[1], route_path[len(hit_route[0]):])).strip('.')
+        return _resolve_route_map(route_path)
@@ -0,0 +1,217 @@
+import asyncio
+import threading
+
+from django.http import StreamingHttpResponse
+
+from .util import codec
+
+# 流式响应的编码方式: {名称: (Content-Type, 开始, 分隔符, 每项前缀, 每项后缀, 结束, 是否合并小块)}
+STREAM_MODES = {
+    # JSON 数组，客户端接收到的内容与非流式响应一致
+    'json': ('application/json', b'[', b',', b'', b'', b']', True),
+    # 每行一个 JSON
+    'ndjson': ('application/x-ndjson', b'', b'', b'', b'\n', b'', True),
+    # Server-Sent Events ，每项数据作为一个事件立即发送
+    'sse': ('text/event-stream', b'', b'', b'data: ', b'\n\n', b'', False),
+}
+
+# 未指定编码方式时使用的编码方式
+DEFAULT_STREAM_MODE = 'json'
+
+# 合并小块时，每次发送的数据大小(字节)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# 在异步分发中，由线程产生且尚未发送的数据块的最大数量
+STREAM_QUEUE_SIZE = 4
+
+# 正在线程中读取的同步迭代器，保持引用以免任务被回收(客户端断开后，任务会在后台继续运行直到线程退出)
+_PRODUCERS = set()
+
+# 数据读取完毕
+_STREAM_END = object()
+
+
+class _StreamError:
+    """
+    在线程中读取数据时发生的异常
+    """
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def check_stream_mode(mode):
+    """
+    检查 @route(stream=...) 的值是否有效
+    :param mode:
+    :return:
+    """
+    if mode is not None and mode not in STREAM_MODES:
+        raise Exception('[restful-dj] Invalid stream mode "%s", expect one of: %s' % (
+            mode, ', '.join(STREAM_MODES)))
+
+
+def create_response(data, mode=None, batch_size: int = None) -> StreamingHttpResponse:
+    """
+    将生成器、迭代器或列表转换成流式响应，数据会逐项编码后发送，不需要全部加载到内存中
+    :param data: 迭代器(可以是异步迭代器)或列表
+    :param mode: 编码方式，见 STREAM_MODES
+    :param batch_size: 使用 json 编码时，每次序列化的项数，不指定时逐项序列化
+    :return:
+    """
+    mode = mode or DEFAULT_STREAM_MODE
+    content_type, start, sep, prefix, suffix, end, merge = STREAM_MODES[mode]
+
+    if hasattr(data, '__aiter__'):
+        content = _encode_async(data, start, sep, prefix, suffix, end, merge)
+    elif batch_size and mode == 'json':
+        content = _encode_batches(data, batch_size)
+    else:
+        content = _encode(data, start, sep, prefix, suffix, end, merge)
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    if mode == 'sse':
+        response['Cache-Control'] = 'no-cache'
+        # 禁止 nginx 缓冲事件
+        response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _encode(items, start, sep, prefix, suffix, end, merge):
+    dumps = codec.dumps
+    buffer = [start]
+    size = len(start)
+    first = True
+    for item in items:
+        chunk = dumps(item)
+        if not first:
+            buffer.append(sep)
+        first = False
+        buffer.append(prefix)
+        buffer.append(chunk)
+        buffer.append(suffix)
+        size += len(chunk)
+        if not merge or size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(end)
+    yield b''.join(buffer)
+
+
+def _encode_batches(items, batch_size: int):
+    """
+    分批序列化成 JSON 数组，每批只需要调用一次序列化函数
+    """
+    dumps = codec.dumps
+    sep = b'['
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            # 去掉这一批数据的 [ 与 ]
+            yield sep + dumps(batch)[1:-1]
+            sep = b','
+            batch = []
+
+    if batch:
+        yield sep + dumps(batch)[1:-1] + b']'
+    else:
+        yield b'[]' if sep == b'[' else b']'
+
+
+async def _encode_async(items, start, sep, prefix, suffix, end, merge):
+    dumps = codec.dumps
+    buffer = [start]
+    size = len(start)
+    first = True
+    async for item in items:
+        chunk = dumps(item)
+        if not first:
+            buffer.append(sep)
+        first = False
+        buffer.append(prefix)
+        buffer.append(chunk)
+        buffer.append(suffix)
+        size += len(chunk)
+        if not merge or size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(end)
+    yield b''.join(buffer)
+
+
+def to_async_response(response, run_sync):
+    """
+    在异步分发(ASGI)中，将使用同步迭代器的流式响应转换成异步的流式响应
+    否则 Django 会先将同步迭代器的全部内容读取到内存中
+    :param response:
+    :param run_sync: 执行同步函数的方式，整个迭代器会在同一个线程中读取(如数据库游标)
+    :return:
+    """
+    # Django 4.2 以下版本不支持异步迭代器
+    if not getattr(response, 'streaming', False) or getattr(response, 'is_async', True):
+        return response
+
+    response.streaming_content = _iterate_in_thread(iter(response.streaming_content), run_sync)
+    return response
+
+
+async def _iterate_in_thread(iterator, run_sync):
+    """
+    在一个线程中读取同步迭代器，并以异步迭代器的形式返回其数据
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue()
+    # 可以放入队列的数据块数量，用于在发送较慢时阻塞读取
+    slots = threading.Semaphore(STREAM_QUEUE_SIZE)
+    closed = threading.Event()
+
+    def put(item):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def produce():
+        try:
+            for chunk in iterator:
+                slots.acquire()
+                # 客户端已断开，不再读取
+                if closed.is_set():
+                    break
+                put(chunk)
+        except Exception as e:
+            put(_StreamError(e))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            put(_STREAM_END)
+
+    async def run():
+        try:
+            await run_sync(produce)
+        except Exception as e:
+            # 如: 线程池已满
+            queue.put_nowait(_StreamError(e))
+            queue.put_nowait(_STREAM_END)
+
+    task = asyncio.ensure_future(run())
+    _PRODUCERS.add(task)
+    task.add_done_callback(_PRODUCERS.discard)
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                return
+            if isinstance(item, _StreamError):
+                raise item.error
+            slots.release()
+            yield item
+    finally:
+        # 不等待线程退出: 线程可能阻塞在读取下一个数据块(如 SSE 等待新事件)，
+        # 其会在读取到下一个数据块后退出，并自行关闭迭代器
+        closed.set()
+        slots.release()
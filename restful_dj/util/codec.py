@@ -0,0 +1,44 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+def _default_dumps(data):
+    # 与 django.http.JsonResponse 的默认序列化方式一致
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+JSON_LOADS = json.loads
+JSON_DUMPS = _default_dumps
+
+
+def set_json_codec(loads=None, dumps=None):
+    """
+    设置 JSON 编解码函数，用于解析请求体与序列化响应数据，默认使用标准库 json
+    可以替换成更快的实现，如: set_json_codec(orjson.loads, orjson.dumps)
+    :param loads: 解析函数，其参数可能是 str 或 bytes ，为 None 时使用标准库
+    :param dumps: 序列化函数，可以返回 str 或 bytes ，为 None 时使用标准库
+    :return:
+    """
+    global JSON_LOADS, JSON_DUMPS
+    JSON_LOADS = json.loads if loads is None else loads
+    JSON_DUMPS = _default_dumps if dumps is None else dumps
+
+
+def loads(data):
+    """
+    解析 JSON
+    :param data: str 或 bytes ，bytes 会直接交给解析函数，不需要先解码
+    :return:
+    """
+    return JSON_LOADS(data)
+
+
+def dumps(data) -> bytes:
+    """
+    序列化成 JSON
+    :param data:
+    :return:
+    """
+    content = JSON_DUMPS(data)
+    return content.encode() if isinstance(content, str) else content
@@ -2,12 +2,20 @@
 
 # 此模块用于收集路由
 
+import ast
+import hashlib
+import json
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from os import path
 
 from django.conf import settings
 
+from . import logger
+from .utils import dump_func_args, load_module
+
 # 全局类列表
 GLOBAL_CLASSES = []
 
@@ -45,23 +53,34 @@ def _get_route_map():
     return ROUTES_MAP.items()
 
 
-def collect(*environments):
+def collect(*environments, workers=None, manifest=None):
     """
     执行收集操作
+    :param environments: 路由装饰器参数中使用的类型，与 register_globals 注册的全局类型一起使用
+    :param workers: 解析文件的进程数量，默认为 CPU 数量，为 1 时不使用多进程
+    :param manifest: 清单文件路径，其中记录了各文件的哈希值与解析结果，指定时只会重新解析有变化的文件
     :return: 所有路由的集合
     """
+    return _collect(environments, workers, manifest)[0]
+
+
+def _collect(environments, workers=None, manifest=None):
+    """
+    执行收集操作
+    :return: (所有路由的集合, 所有路由文件的完整路径)
+    """
     # 为 route 提供的执行环境
     # 读取在 settings.py 中配置的环境
-    route_env = _get_env(fake_route, *environments)
+    route_env = _get_env(*environments)
     project_root = settings.BASE_DIR
 
-    # 所有路由的集合
-    routes = []
+    # 需要解析的文件: (路由根路径, 文件完整路径, http 请求前缀, 包前缀)
+    route_files = []
 
     for (http_prefix, pkg_prefix) in _get_route_map():
         route_root = path.abspath(path.join(project_root, pkg_prefix.replace('.', path.sep)))
 
-        # 遍历目录，找出所有的 .py 文件
+        # 遍历目录，找出所有的 .py 文件(包括 __init__.py)
         for (dir_name, dirs, files) in os.walk(route_root):
             for file in files:
                 # 不是 .py 文件，忽略
@@ -69,56 +88,300 @@ def collect(*environments):
                     continue
 
                 fullname = path.abspath(path.join(dir_name, file))
-                # 解析文件
-                get_route_defines(route_root, fullname, http_prefix, pkg_prefix, routes, route_env)
+                route_files.append((route_root, fullname, http_prefix, pkg_prefix))
+
+    # 所有路由的集合
+    routes = []
+
+    # 解析文件
+    parsed_files = _parse_files([item[1] for item in route_files], workers, manifest)
+
+    for (route_root, fullname, http_prefix, pkg_prefix), decorators in zip(route_files, parsed_files):
+        for define in resolve_file(route_root, fullname, http_prefix, pkg_prefix, route_env, decorators):
+            routes.append(define)
+
+    return routes, [item[1] for item in route_files]
+
+
+# 文件数量少于此值时，不使用多进程解析
+_PARALLEL_THRESHOLD = 32
+
+
+# 文件解析结果的缓存，在同一进程内多次收集时，只重新解析有变化的文件
+# 其键为文件的完整路径，值为 {'mtime', 'size', 'hash', 'decorators', 'error', 'args'}
+# args 为文件中各路由处理函数的持久化参数列表 {函数名称: dump_func_args 的返回值}，在持久化时填充
+_FILE_CACHE = {}
+
+# 清单文件格式的版本，格式变化时，旧的清单文件会被忽略
+_MANIFEST_VERSION = 3
+
+
+def _get_manifest_key(fullname: str) -> str:
+    # 清单中使用相对于项目根目录的路径，以便于在不同的机器上使用
+    return path.relpath(fullname, settings.BASE_DIR).replace(path.sep, '/')
+
+
+def _load_manifest(manifest: str) -> dict:
+    """
+    读取清单文件
+    :param manifest:
+    :return: 其键为文件的完整路径
+    """
+    if not path.isfile(manifest):
+        return {}
+
+    try:
+        with open(manifest, encoding='utf-8') as fp:
+            data = json.load(fp)
+        if data.get('version') != _MANIFEST_VERSION:
+            return {}
+        entries = {}
+        for key, entry in data['files'].items():
+            entry['decorators'] = ast.literal_eval(entry['decorators'])
+            entry['args'] = ast.literal_eval(entry['args'])
+            entries[path.abspath(path.join(settings.BASE_DIR, key))] = entry
+        return entries
+    except (OSError, ValueError, SyntaxError, KeyError, TypeError) as e:
+        logger.warning('[restful-dj] Load manifest file "%s" failed, all files will be parsed: %s' % (manifest, repr(e)))
+        return {}
+
+
+def _save_manifest(manifest: str, entries: dict):
+    """
+    写入清单文件
+    :param manifest:
+    :param entries: 其键为文件的完整路径
+    :return:
+    """
+    files = {}
+    for fullname, entry in entries.items():
+        files[_get_manifest_key(fullname)] = {
+            'mtime': entry['mtime'],
+            'size': entry['size'],
+            'hash': entry['hash'],
+            # 装饰器参数可能包含 json 不支持的字面量(如 tuple, set)，所以使用 repr 保存，读取时使用 ast.literal_eval 还原
+            'decorators': repr(entry['decorators']),
+            'error': entry['error'],
+            'args': repr(entry.get('args') or {})
+        }
+
+    temp_file = '%s.tmp' % manifest
+    with open(temp_file, mode='wt', encoding='utf-8') as fp:
+        json.dump({'version': _MANIFEST_VERSION, 'files': files}, fp, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(temp_file, manifest)
+
+
+def _is_manifest_changed(old_entries: dict, new_entries: dict) -> bool:
+    if set(old_entries) != set(new_entries):
+        return True
+    for fullname, entry in new_entries.items():
+        old_entry = old_entries[fullname]
+        if (old_entry['mtime'], old_entry['size'], old_entry['hash']) != (entry['mtime'], entry['size'], entry['hash']):
+            return True
+    return False
+
+
+def _get_file_hash(fullname: str) -> str:
+    with open(fullname, mode='rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def _parse_files(files: list, workers=None, manifest=None) -> list:
+    """
+    解析文件中的路由装饰器，只解析有变化的文件
+    :param files: 文件完整路径列表
+    :param workers: 进程数量
+    :param manifest: 清单文件路径
+    :return: 与 files 顺序一致的解析结果
+    """
+    manifest_entries = {} if manifest is None else _load_manifest(manifest)
+
+    entries = {}
+    # 需要重新解析的文件
+    pending = []
+    for fullname in files:
+        stat = os.stat(fullname)
+        entry = _FILE_CACHE.get(fullname) or manifest_entries.get(fullname)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            entries[fullname] = entry
+            continue
+
+        digest = _get_file_hash(fullname)
+        if entry is not None and entry['hash'] == digest:
+            # 仅修改时间发生了变化，内容未变
+            entry = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+            entries[fullname] = entry
+        else:
+            # 内容变化后，需要重新获取参数列表
+            entries[fullname] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': digest, 'args': {}}
+            pending.append(fullname)
+
+    for fullname, (decorators, error) in zip(pending, _run_parse(pending, workers)):
+        entries[fullname]['decorators'] = decorators
+        entries[fullname]['error'] = error
+
+    _FILE_CACHE.update(entries)
+
+    if manifest is not None and _is_manifest_changed(manifest_entries, entries):
+        _save_manifest(manifest, entries)
+
+    decorators_list = []
+    for fullname in files:
+        entry = entries[fullname]
+        if entry['error'] is not None:
+            logger.warning('[restful-dj] Parse route file "%s" failed: %s' % (fullname, entry['error']))
+        decorators_list.append(entry['decorators'])
+    return decorators_list
 
-            for sub_dir_name in dirs:
-                pkg_file = path.abspath(path.join(sub_dir_name, '__init__.py'))
-                if path.exists(pkg_file) and path.isfile(pkg_file):
-                    get_route_defines(route_root, pkg_file, http_prefix, pkg_prefix, routes, route_env)
 
-    return routes
+def _run_parse(files: list, workers=None) -> list:
+    """
+    解析文件，文件较多时使用多进程解析
+    :param files: 文件完整路径列表
+    :param workers: 进程数量
+    :return: 与 files 顺序一致的 parse_file 返回值
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(files) < _PARALLEL_THRESHOLD:
+        return [parse_file(file) for file in files]
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(parse_file, files, chunksize=max(1, len(files) // (workers * 4))))
+    except (BrokenProcessPool, OSError) as e:
+        # 无法创建子进程时(如 Windows 下未使用 if __name__ == '__main__' 保护的脚本)，在当前进程中解析
+        logger.warning('[restful-dj] Parse route files in parallel failed, fallback to serial: %s' % repr(e))
+        return [parse_file(file) for file in files]
+
+
+# 装饰器参数的类型
+# 字面量，如: 'name', 1, True, None, [1, 2]
+_ARG_LITERAL = 'literal'
+# 名称引用，如: RouteTypes.TEST ，需要从注册的全局类型中读取
+_ARG_REFERENCE = 'reference'
+# 无法静态解析的表达式
+_ARG_UNKNOWN = 'unknown'
+
+
+def _is_route_decorator(node) -> bool:
+    """
+    判断是否是 @route(...) 或 @xxx.route(...) 装饰器
+    """
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id == 'route'
+    if isinstance(func, ast.Attribute):
+        return func.attr == 'route'
+    return False
 
 
-def get_route_defines(route_root, fullname, http_prefix, pkg_prefix, routes, route_env):
-    for define in resolve_file(route_root, fullname, http_prefix, pkg_prefix, route_env):
-        # 返回 None 表示没有找到定义
-        if define is None:
+def _get_arg_define(node):
+    """
+    静态解析装饰器参数
+    :param node:
+    :return: (参数类型, 值)
+    """
+    try:
+        return _ARG_LITERAL, ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        pass
+
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+
+    if isinstance(node, ast.Name):
+        names.append(node.id)
+        return _ARG_REFERENCE, '.'.join(reversed(names))
+
+    return _ARG_UNKNOWN, getattr(node, 'lineno', 0)
+
+
+def parse_file(fullname: str):
+    """
+    使用 ast 解析文件中的路由装饰器，不会导入模块，也不会执行任何代码
+    此函数会在子进程中执行，因此其返回值只包含基本类型
+    :param fullname: 文件的完整路径
+    :return: ([(函数名称, 位置参数列表, 关键字参数列表), ...], 解析失败时的错误信息)
+    """
+    try:
+        with open(fullname, encoding='utf-8') as python_fp:
+            source = python_fp.read()
+        tree = ast.parse(source, fullname)
+    except (OSError, SyntaxError, ValueError) as e:
+        return [], str(e)
+
+    decorators = []
+    # 只处理模块顶层定义的函数
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
             continue
-        routes.append(define)
+        for decorator in node.decorator_list:
+            if not _is_route_decorator(decorator):
+                continue
+            args = [_get_arg_define(arg) for arg in decorator.args]
+            keywords = [(keyword.arg, _get_arg_define(keyword.value)) for keyword in decorator.keywords]
+            decorators.append((node.name, args, keywords))
+            break
+
+    return decorators, None
 
 
-def resolve_file(route_define, fullname, http_prefix, pkg_prefix, route_env: dict):
+def _resolve_arg(fullname: str, func: str, arg_define: tuple, route_env: dict):
+    """
+    将静态解析的装饰器参数转换为实际的值
+    :return:
+    """
+    arg_type, value = arg_define
+
+    if arg_type == _ARG_LITERAL:
+        return value
+
+    if arg_type == _ARG_REFERENCE:
+        names = value.split('.')
+        if names[0] in route_env:
+            obj = route_env[names[0]]
+            try:
+                for name in names[1:]:
+                    obj = getattr(obj, name)
+                return obj
+            except AttributeError:
+                pass
+        logger.warning('[restful-dj] Cannot resolve "%s" in decorator of "%s" (%s), did you forgot to register it '
+                       'with `restful_dj.register_globals`?' % (value, func, fullname))
+        return None
+
+    logger.warning('[restful-dj] Unsupported expression in decorator of "%s" (%s, line %s), only literals and '
+                   'registered globals are allowed' % (func, fullname, value))
+    return None
+
+
+def resolve_file(route_define, fullname, http_prefix, pkg_prefix, route_env: dict, decorators: list):
     """
     解析文件
-    :param route_env:
+    :param route_env: 装饰器参数中可以使用的类型
     :param pkg_prefix:
     :param http_prefix: http 请求前缀
     :param route_define: 路由文件的根路径
     :param fullname: 文件的完整路径
-    :return: 没有路由时返回 None
-    """
-    with open(fullname, encoding='utf-8') as python_fp:
-        lines = python_fp.readlines()
-        python_fp.close()
-    source = ''.join(lines)
-
-    # 解析路由的定义
-    # defines = re.compile(r'^@(route\(.+?\)).*(\n.*?)+^def (.+?)\(', re.M).findall(source)
-    defines = re.compile(r'^@(route\(.+?\))(.*?)^def (.+?)\(', re.M | re.S).findall(source)
-    # 没有找到定义，返回 None
-    if len(defines) == 0:
-        yield None
-
-    # router_str 是在函数上声明的装饰器定义
-    # other_lines 是装饰器与函数声明间的其它代码
+    :param decorators: 由 parse_file 解析出的路由装饰器
+    :return: 路由定义的生成器
+    """
     # func 是函数的名称
-    for (router_str, other_lines, func) in defines:
+    # args 和 keywords 是装饰器的参数
+    for (func, args, keywords) in decorators:
         # 解析出请求的方法(method)与请求的指定函数名称
         method, name = resolve_func(func)
-        # 利用 eval 解析出路由的定义（在这个文件中定义了与装饰器相同的函数，以便于读取装饰器的参数）
-        router_str = router_str.replace('route', 'fake_route')
-        define = eval(router_str, route_env)
+        # 利用与装饰器相同签名的函数，读取装饰器的参数
+        define = fake_route(
+            *[_resolve_arg(fullname, func, arg, route_env) for arg in args],
+            **{key: _resolve_arg(fullname, func, arg, route_env) for key, arg in keywords if key is not None}
+        )
 
         # 构造http请求的地址
         # -3 是为了干掉最后的 .py 字样
@@ -184,7 +447,7 @@ def resolve_func(func: str):
 
 # 生成：注册路由的代码 -- 模板
 # 注意生成的代码中的缩进，使用的是空格
-_REGISTER_STMT = "    # {module}-{name}\n    ['{method}', '{path}', {handler}]"
+_REGISTER_STMT = "    # {module}-{name}\n    ['{method}', '{path}', {handler}, {args}]"
 _CODE_TPL = """# -*- coding={encoding} -*-
 
 # IMPORT ROUTES BEGIN
@@ -200,37 +463,106 @@ routes = [
 """
 
 
-def persist(filename: str = '', encoding='utf8'):
+def _get_persist_args(route: dict):
+    """
+    获取路由处理函数的参数列表数据，以写入路由映射文件
+    文件内容未变化时，使用上次持久化时记录在清单中的数据，不需要导入路由模块
+    :param route:
+    :return: (参数列表数据, 是否是新获取的)，无法获取时参数列表数据为 None ，此时会在注册路由时通过反射获取
+    """
+    cached_args = _FILE_CACHE[route['file']].setdefault('args', {})
+    if route['handler'] in cached_args:
+        return cached_args[route['handler']], False
+
+    # noinspection PyBroadException
+    try:
+        handler = getattr(load_module(route['pkg']), route['handler'])
+        args = dump_func_args(handler.route_meta.func_args)
+    except Exception as e:
+        # 不记录到清单中，下次持久化时重试
+        logger.warning('[restful-dj] Load arguments of "%s.%s" failed: %s' % (route['pkg'], route['handler'], repr(e)))
+        return None, False
+
+    if args is None:
+        logger.info('[restful-dj] Arguments of "%s.%s" cannot be persisted, they will be resolved at startup' % (
+            route['pkg'], route['handler']))
+    cached_args[route['handler']] = args
+    return args, True
+
+
+def get_manifest_name(filename: str) -> str:
+    """
+    获取路由映射文件对应的清单文件路径
+    :param filename: 路由映射文件路径，如: restful_map.py
+    :return: 如: restful_map.manifest.json
+    """
+    return '%s.manifest.json' % path.splitext(filename)[0]
+
+
+def persist(filename: str = '', encoding='utf8', workers=None, lazy=False):
     """
     将路由持久化
+    指定了 filename 时，会在其旁边生成一个清单文件，下次持久化时只重新解析有变化的文件，
+    若生成的内容与已有文件一致，则不会写入文件
     :param filename:
     :param encoding:
+    :param workers: 解析文件的进程数量，参见 collect
+    :param lazy: 是否延迟加载路由，为 True 时生成的代码不会导入路由模块，而是在路由首次被请求时才导入
     :return: 持久化的 python 代码
     :rtype: str or None
     """
     imports = []
     routes = []
 
+    manifest = get_manifest_name(filename) if filename else None
+    # 是否有新获取的参数列表，需要更新清单文件
+    args_changed = False
+
     print('[restful-dj] Generating restful map file with encoding %s' % encoding)
-    for route in collect():
+    collected_routes, route_files = _collect((), workers=workers, manifest=manifest)
+    for route in collected_routes:
         # imports.append('from %s import %s as %s' % (route['pkg'], route['handler'], route['id']))
-        imports.append('from %s import %s as %s' % (route['pkg'], route['handler'], route['id']))
+        if lazy:
+            handler = repr('%s:%s' % (route['pkg'], route['handler']))
+        else:
+            imports.append('from %s import %s as %s' % (route['pkg'], route['handler'], route['id']))
+            handler = route['id']
+        args, is_new = _get_persist_args(route)
+        args_changed = args_changed or is_new
         routes.append(_REGISTER_STMT.format(
             module=route['module'],
             name=route['name'],
             method=route['method'].upper(),
             path=route['path'],
-            handler=route['id']
+            handler=handler,
+            args=repr(args)
         ))
 
+    if manifest is not None and args_changed:
+        _save_manifest(manifest, {fullname: _FILE_CACHE[fullname] for fullname in route_files})
+
     content = _CODE_TPL.format(encoding=encoding, imports='\n'.join(imports), routes=',\n'.join(routes))
 
     print('[restful-dj] Generate restful map file complete')
     if not filename:
         return content
 
+    if _is_content_unchanged(filename, content, encoding):
+        print('[restful-dj] Routes not changed, skip persisting')
+        return
+
     print('[restful-dj] Persisting into file %s' % filename)
     with open(filename, mode='wt', encoding=encoding) as fp:
         fp.write(content)
         fp.close()
     print('[restful-dj] Routes persisted')
+
+
+def _is_content_unchanged(filename: str, content: str, encoding: str) -> bool:
+    if not path.isfile(filename):
+        return False
+    try:
+        with open(filename, encoding=encoding) as fp:
+            return fp.read() == content
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,477 @@
+import collections.abc
+import inspect
+import typing
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+from enum import Enum, Flag
+from uuid import UUID
+
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+
+from . import codec
+
+# 转换失败时，转换函数返回此值(不抛出异常)
+INVALID = object()
+
+# 类型转换函数的工厂: {类型: factory(annotation) -> convert(value)}
+# 查找时会沿着类型的 __mro__ 向上查找，因此为基类注册的工厂同样适用于其子类
+CONVERTERS = {}
+
+# 以列表形式接收多个值的容器类型
+_MULTIPLE_TYPES = (list, tuple, set, frozenset)
+
+# 以列表形式接收多个值的抽象容器类型(如 Sequence[int] 的 __origin__)，及转换后的容器类型
+_ABSTRACT_MULTIPLE_TYPES = {
+    collections.abc.Sequence: list,
+    collections.abc.MutableSequence: list,
+    collections.abc.Collection: list,
+    collections.abc.Iterable: list,
+    collections.abc.Set: set,
+    collections.abc.MutableSet: set
+}
+
+_NONE_TYPE = type(None)
+
+try:
+    from types import UnionType as _UnionType
+except ImportError:
+    # Python 3.10 以下版本不支持 int | None 的写法
+    _UnionType = None
+
+
+def get_origin(annotation):
+    """
+    获取泛型类型的原始类型，如: List[int] 返回 list ，Optional[int] 返回 typing.Union
+    :param annotation:
+    :return: 不是泛型时返回 None
+    """
+    if _UnionType is not None and isinstance(annotation, _UnionType):
+        return typing.Union
+    return getattr(annotation, '__origin__', None)
+
+
+def get_args(annotation) -> tuple:
+    """
+    获取泛型类型的参数，如: Dict[str, int] 返回 (str, int)
+    """
+    return getattr(annotation, '__args__', None) or ()
+
+
+def is_valid_annotation(annotation) -> bool:
+    """
+    判断是否是支持的类型声明: 类型，或 typing 的泛型(如 List[int], Optional[int])
+    """
+    return inspect.isclass(annotation) or annotation is typing.Any or get_origin(annotation) is not None
+
+
+def get_type_name(annotation) -> str:
+    """
+    获取类型声明的显示名称，如: int, List[int]
+    """
+    if inspect.isclass(annotation) and get_origin(annotation) is None:
+        return annotation.__name__
+    return repr(annotation).replace('typing.', '')
+
+
+def is_multiple(annotation) -> bool:
+    """
+    判断此类型的参数是否需要以列表的形式接收多个值(如 ?id=1&id=2)
+    """
+    origin = get_origin(annotation)
+    if origin is typing.Union:
+        return any(is_multiple(arg) for arg in get_args(annotation) if arg is not _NONE_TYPE)
+    if origin is not None:
+        annotation = origin
+    return annotation in _ABSTRACT_MULTIPLE_TYPES or \
+        (inspect.isclass(annotation) and issubclass(annotation, _MULTIPLE_TYPES))
+
+
+def register_converter(annotation, convert):
+    """
+    注册类型转换函数，路由处理函数参数的类型声明为此类型(或其子类)时，使用此函数转换参数值
+    用于子类时，若转换结果不是子类的实例，会再使用转换结果构造子类，即: cls(convert(value))
+    :param annotation: 类型
+    :param convert: 转换函数，其参数为请求中的参数值，转换失败时可以抛出任意异常
+    :return:
+    """
+
+    def factory(cls):
+        def convert_value(value):
+            if isinstance(value, cls):
+                return value
+            # noinspection PyBroadException
+            try:
+                return convert(value)
+            except Exception:
+                return INVALID
+
+        return convert_value
+
+    CONVERTERS[annotation] = factory
+
+
+def compile_converter(annotation):
+    """
+    根据类型声明生成转换函数，在路由注册时调用一次
+    :param annotation:
+    :return: 转换函数，其参数不会是 None ，转换失败时返回 INVALID ；不需要转换时返回 None
+    """
+    if annotation is typing.Any or annotation is object:
+        return None
+
+    # 如: TypeVar
+    if not is_valid_annotation(annotation):
+        return None
+
+    origin = get_origin(annotation)
+    if origin is typing.Union:
+        return _compile_union(annotation)
+
+    if origin is not None:
+        return _compile_generic(annotation, origin)
+
+    mro = inspect.getmro(annotation)
+    # IntEnum 、class K(str, Enum) 等同时继承了 int 、str 的枚举，需要按枚举转换
+    if issubclass(annotation, Enum):
+        mro = [cls for cls in mro if issubclass(cls, Enum)]
+
+    for cls in mro:
+        factory = CONVERTERS.get(cls)
+        if factory is None:
+            continue
+        # 枚举的转换函数直接返回其成员，不需要构造
+        if cls is annotation or cls is Enum:
+            return factory(annotation)
+        return _compile_subclass(annotation, factory(annotation))
+
+    return _compile_class(annotation)
+
+
+def _compile_subclass(cls, convert):
+    """
+    为基类注册的转换函数用于子类时(如 class MyInt(int))，使用转换结果构造子类
+    """
+
+    def convert_value(value):
+        if isinstance(value, cls):
+            return value
+        result = convert(value)
+        if result is INVALID or isinstance(result, cls):
+            return result
+        # noinspection PyBroadException
+        try:
+            return cls(result)
+        except Exception:
+            return INVALID
+
+    return convert_value
+
+
+def _compile_class(cls):
+    """
+    未注册转换函数的类型，直接调用其构造函数进行转换
+    """
+
+    def convert_value(value):
+        if isinstance(value, cls):
+            return value
+        # noinspection PyBroadException
+        try:
+            return cls(value)
+        except Exception:
+            return INVALID
+
+    return convert_value
+
+
+def _compile_union(annotation):
+    """
+    Optional[X] / Union[X, Y]: 依次尝试各个类型，使用第一个转换成功的值
+    """
+    types = [arg for arg in get_args(annotation) if arg is not _NONE_TYPE]
+    if len(types) == 1:
+        return compile_converter(types[0])
+
+    converters = [compile_converter(arg) for arg in types]
+    if any(convert is None for convert in converters):
+        return None
+
+    def convert_value(value):
+        for convert in converters:
+            result = convert(value)
+            if result is not INVALID:
+                return result
+        return INVALID
+
+    return convert_value
+
+
+def _compile_generic(annotation, origin):
+    args = get_args(annotation)
+
+    if not inspect.isclass(origin):
+        return None
+
+    if issubclass(origin, dict) or origin in (collections.abc.Mapping, collections.abc.MutableMapping):
+        return _compile_dict(args)
+
+    if issubclass(origin, tuple) and args and args[-1] is not Ellipsis:
+        return _compile_fixed_tuple(args)
+
+    if issubclass(origin, _MULTIPLE_TYPES):
+        return _compile_sequence(origin, args[0] if args else typing.Any)
+
+    container = _ABSTRACT_MULTIPLE_TYPES.get(origin)
+    if container is not None:
+        return _compile_sequence(container, args[0] if args else typing.Any)
+
+    return _compile_class(origin)
+
+
+def _to_list(value):
+    """
+    将参数值转换成列表: 字符串会尝试作为 JSON 数组解析，单个值会作为只有一项的列表
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return value
+    if isinstance(value, (str, bytes)) and value[:1] in ('[', b'['):
+        # noinspection PyBroadException
+        try:
+            value = codec.loads(value)
+        except Exception:
+            return INVALID
+        return value if isinstance(value, list) else INVALID
+    return [value]
+
+
+def _compile_sequence(container, item_type):
+    convert_item = compile_converter(item_type)
+
+    def convert_value(value):
+        items = _to_list(value)
+        if items is INVALID:
+            return INVALID
+        if convert_item is None:
+            return items if type(items) is container else container(items)
+
+        result = []
+        for item in items:
+            if item is not None:
+                item = convert_item(item)
+                if item is INVALID:
+                    return INVALID
+            result.append(item)
+        return result if container is list else container(result)
+
+    return convert_value
+
+
+def _compile_fixed_tuple(item_types):
+    converters = [compile_converter(arg) for arg in item_types]
+    size = len(converters)
+
+    def convert_value(value):
+        items = _to_list(value)
+        if items is INVALID or len(items) != size:
+            return INVALID
+
+        result = []
+        for convert, item in zip(converters, items):
+            if convert is not None and item is not None:
+                item = convert(item)
+                if item is INVALID:
+                    return INVALID
+            result.append(item)
+        return tuple(result)
+
+    return convert_value
+
+
+def _compile_dict(args):
+    convert_key = compile_converter(args[0]) if args else None
+    convert_item = compile_converter(args[1]) if len(args) > 1 else None
+
+    def convert_value(value):
+        if isinstance(value, (str, bytes)):
+            # noinspection PyBroadException
+            try:
+                value = codec.loads(value)
+            except Exception:
+                return INVALID
+        if not isinstance(value, dict):
+            return INVALID
+        if convert_key is None and convert_item is None:
+            return value
+
+        result = {}
+        for key, item in value.items():
+            if convert_key is not None:
+                key = convert_key(key)
+                if key is INVALID:
+                    return INVALID
+            if convert_item is not None and item is not None:
+                item = convert_item(item)
+                if item is INVALID:
+                    return INVALID
+            result[key] = item
+        return result
+
+    return convert_value
+
+
+# noinspection PyUnusedLocal
+def _compile_bool(cls):
+    def convert_value(value):
+        if isinstance(value, bool):
+            return value
+        if value in ('true', 'True', '1', 1):
+            return True
+        if value in ('false', 'False', '0', 0):
+            return False
+        return INVALID
+
+    return convert_value
+
+
+# noinspection PyUnusedLocal
+def _compile_int(cls):
+    def convert_value(value):
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str):
+            # 与 int() 的规则保持一致(如允许 1_000)，格式不正确或位数超出限制时抛出 ValueError
+            try:
+                return int(value)
+            except ValueError:
+                return INVALID
+        # noinspection PyBroadException
+        try:
+            return int(value)
+        except Exception:
+            return INVALID
+
+    return convert_value
+
+
+# noinspection PyUnusedLocal
+def _compile_float(cls):
+    def convert_value(value):
+        if isinstance(value, float):
+            return value
+        # noinspection PyBroadException
+        try:
+            return float(value)
+        except Exception:
+            return INVALID
+
+    return convert_value
+
+
+# noinspection PyUnusedLocal
+def _compile_str(cls):
+    def convert_value(value):
+        return value if isinstance(value, str) else str(value)
+
+    return convert_value
+
+
+# noinspection PyUnusedLocal
+def _compile_decimal(cls):
+    def convert_value(value):
+        if isinstance(value, Decimal):
+            return value
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            return INVALID
+        try:
+            # 使用字符串构造，避免浮点数的精度问题
+            return Decimal(value if isinstance(value, str) else str(value))
+        except InvalidOperation:
+            return INVALID
+
+    return convert_value
+
+
+# noinspection PyUnusedLocal
+def _compile_uuid(cls):
+    def convert_value(value):
+        if isinstance(value, UUID):
+            return value
+        if not isinstance(value, str):
+            return INVALID
+        try:
+            return UUID(value)
+        except ValueError:
+            return INVALID
+
+    return convert_value
+
+
+def _compile_date_parser(parse):
+    def factory(cls):
+        def convert_value(value):
+            if isinstance(value, cls):
+                return value
+            if not isinstance(value, str):
+                return INVALID
+            try:
+                # 格式不正确时返回 None ，格式正确但值无效时抛出 ValueError
+                result = parse(value)
+            except ValueError:
+                return INVALID
+            return INVALID if result is None else result
+
+        return convert_value
+
+    return factory
+
+
+def _compile_enum(cls):
+    # 按值、值的字符串形式(如 ?type=1)以及成员名称查找
+    by_value = {}
+    by_name = {}
+    for name, member in cls.__members__.items():
+        by_name[name] = member
+        by_name.setdefault(str(member.value), member)
+        try:
+            by_value.setdefault(member.value, member)
+        except TypeError:
+            # 不可哈希的值
+            pass
+
+    # 标志(Flag/IntFlag)可以是多个成员的组合，如: ?perm=6
+    convert_int = _compile_int(int) if issubclass(cls, Flag) else None
+
+    def convert_value(value):
+        if isinstance(value, cls):
+            return value
+        try:
+            member = by_value.get(value)
+        except TypeError:
+            member = None
+        if member is None and isinstance(value, str):
+            member = by_name.get(value)
+        if member is None and convert_int is not None:
+            number = convert_int(value)
+            if number is not INVALID:
+                try:
+                    member = cls(number)
+                except ValueError:
+                    member = None
+        return INVALID if member is None else member
+
+    return convert_value
+
+
+CONVERTERS.update({
+    bool: _compile_bool,
+    int: _compile_int,
+    float: _compile_float,
+    str: _compile_str,
+    Decimal: _compile_decimal,
+    UUID: _compile_uuid,
+    # datetime 是 date 的子类，需要分别注册
+    datetime: _compile_date_parser(parse_datetime),
+    date: _compile_date_parser(parse_date),
+    time: _compile_date_parser(parse_time),
+    Enum: _compile_enum
+})
@@ -1,10 +1,13 @@
+import importlib
 import inspect
 import json
 import re
+import sys
 from collections import OrderedDict
 
 from django.http import HttpRequest
 
+from . import converter
 from . import logger
 
 
@@ -19,16 +22,21 @@ def _get_parameter_alias(match):
     return '' if ch is None else ch.upper()
 
 
+# 表示根据参数名称自动生成别名
+_AUTO_ALIAS = object()
+
+
 class ArgumentSpecification:
     """
     函数参数声明
     """
 
-    def __init__(self, name: str, index: int):
+    def __init__(self, name: str, index: int, alias=_AUTO_ALIAS):
         """
 
         :param name: 参数名称
         :param index: 参数在参数位置中的位置
+        :param alias: 参数别名，不指定时根据名称生成
         """
         self.name = name
         self.index = index
@@ -44,6 +52,10 @@ class ArgumentSpecification:
         self.default = None
         # 注释
         self.comment = None
+        # 已指定别名(如从持久化的参数列表中加载时)
+        if alias is not _AUTO_ALIAS:
+            self.alias = alias
+            return
         # 别名，当路由处理函数中声明的是 abc_def 时，自动处理为 abcDef
         # 同时会移除所有的 _ 符号
         self.alias = re.sub('_+(?P<ch>.?)', _get_parameter_alias, name)
@@ -53,10 +65,10 @@ class ArgumentSpecification:
 
     @property
     def annotation_name(self):
-        return self.annotation.__name__ if self.has_annotation else 'any'
+        return converter.get_type_name(self.annotation) if self.has_annotation else 'any'
 
     def __str__(self):
-        arg_type = self.annotation.__name__ if self.has_annotation else 'any'
+        arg_type = self.annotation_name
 
         name = self.name
 
@@ -132,8 +144,8 @@ def get_func_args(func):
         # 类型
         annotation = parameter.annotation
 
-        # 无效的类型声明
-        if not inspect.isclass(annotation):
+        # 无效的类型声明，支持类型与 typing 的泛型(如 List[int], Optional[int])
+        if not converter.is_valid_annotation(annotation):
             source_lines = inspect.getsourcelines(func)
             line = source_lines[1]
             row = None
@@ -177,6 +189,112 @@ def get_func_args(func):
     return args
 
 
+def _get_type_ref(cls):
+    """
+    获取类型的引用路径，格式为 module:qualname
+    :param cls:
+    :return: 无法通过引用路径还原时返回 None
+    """
+    module = getattr(cls, '__module__', None)
+    qualname = getattr(cls, '__qualname__', None)
+    if not isinstance(module, str) or not isinstance(qualname, str) or '<' in qualname:
+        return None
+
+    ref = '%s:%s' % (module, qualname)
+    # noinspection PyBroadException
+    try:
+        if resolve_type_ref(ref) is cls:
+            return ref
+    except Exception:
+        pass
+    return None
+
+
+def resolve_type_ref(ref: str):
+    """
+    根据引用路径获取类型
+    :param ref: 格式为 module:qualname
+    :return:
+    """
+    module_name, _, qualname = ref.partition(':')
+    obj = sys.modules.get(module_name)
+    if obj is None:
+        obj = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def dump_func_args(args: OrderedDict):
+    """
+    将函数的参数列表转换为字面量数据，以便于写入 python 代码，加载时不再需要反射
+    每个参数的格式为: (名称, 别名, 是否是可变参数, 类型引用路径, 是否有默认值, 默认值, 注释)
+    默认值可能引用了其它模块或配置，生成时的值不一定是运行时的值，因此不会写入(始终为 None)，加载时从函数中读取
+    :param args: get_func_args 返回的参数列表
+    :return: 参数的类型无法使用引用路径表示时，返回 None
+    """
+    data = []
+    for spec in args.values():
+        annotation = None
+        if spec.has_annotation:
+            annotation = _get_type_ref(spec.annotation)
+            if annotation is None:
+                return None
+
+        data.append((
+            spec.name,
+            spec.alias,
+            spec.is_variable,
+            annotation,
+            spec.has_default,
+            None,
+            spec.comment
+        ))
+    return data
+
+
+def _get_func_defaults(func) -> dict:
+    """
+    读取函数参数的默认值(不使用 inspect.signature)
+    :param func:
+    :return: {参数名称: 默认值}
+    """
+    defaults = {}
+    code = getattr(func, '__code__', None)
+    positional_defaults = getattr(func, '__defaults__', None)
+    if code is not None and positional_defaults:
+        names = code.co_varnames[:code.co_argcount]
+        defaults.update(zip(names[-len(positional_defaults):], positional_defaults))
+    keyword_defaults = getattr(func, '__kwdefaults__', None)
+    if keyword_defaults:
+        defaults.update(keyword_defaults)
+    return defaults
+
+
+def load_func_args(data: list, func=None) -> OrderedDict:
+    """
+    从 dump_func_args 生成的数据中加载函数的参数列表
+    :param data:
+    :param func: 路由处理函数，用于读取参数的默认值
+    :return:
+    """
+    defaults = {} if func is None else _get_func_defaults(func)
+    args = OrderedDict()
+    # 旧版本生成的数据中包含默认值，同样忽略
+    for index, (name, alias, is_variable, annotation, has_default, _, comment) in enumerate(data):
+        spec = ArgumentSpecification(name, index, alias)
+        spec.is_variable = is_variable
+        spec.comment = comment
+        if annotation is not None:
+            spec.annotation = resolve_type_ref(annotation)
+            spec.has_annotation = True
+        if has_default:
+            spec.default = defaults.get(name)
+            spec.has_default = True
+        args[name] = spec
+    return args
+
+
 def load_module(module_name: str):
     """
     加载模块
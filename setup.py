@@ -26,5 +26,5 @@ setuptools.setup(
         "Topic :: Internet :: WWW/HTTP :: WSGI :: Application",
         "Topic :: Software Development :: Libraries :: Application Frameworks"
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.6',
 )